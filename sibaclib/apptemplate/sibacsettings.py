@@ -6,7 +6,14 @@ SIBACDATASOURCE = {
     'HOST': 'localhost',
     'PORT': '',
     'FULLTEXT': True,                # True if the data source supports full text searches.
-    'FULLTEXT_LANG': 'italian'       # Language used for full text searches.
+    'FULLTEXT_LANG': 'italian',      # Language used for full text searches.
+    'POOL_MIN_SIZE': 1,              # Connections opened when the provider is created.
+    'POOL_MAX_SIZE': 10,             # Max number of pooled connections. 0 disables connection pooling.
+    'POOL_TIMEOUT': 30,              # Seconds to wait for a free connection before raising an error.
+    'POOL_PING_AFTER': 30,           # Seconds of inactivity after which a pooled connection is tested before reuse.
+    'TERMS_CACHE': True,             # Keep dictionary terms in memory, reloading them after changes.
+    'TERMS_CACHE_NOTIFY': True,      # Use LISTEN/NOTIFY to keep the terms cache coherent across processes.
+    'STREAM_ITERSIZE': 2000          # Rows fetched per round trip when streaming large resultsets.
 }
 
 # GEOREFERENCING:
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+
+class TermsDictionary(object):
+    """
+    The terms of a field bound to a dictionary, optimized for lookups.
+
+    terms can be a list of terms or a dictionary that maps every term
+    to its url.
+
+    Usage:
+
+    d = TermsDictionary(["AN", "AP", "MC"])
+    "AN" in d
+    True
+    d.contains("an", case_sensitive=False)
+    True
+    d.starts_with("a")
+    [("AN", None), ("AP", None)]
+    """
+    def __init__(self, terms):
+        """Class constructor."""
+        if hasattr(terms, "get"):
+            self._urls = dict(terms)
+        else:
+            self._urls = dict.fromkeys(terms)
+        self._terms = frozenset(self._urls)
+        self._upper_terms = None
+        self._prefix_keys = None
+        self._prefix_terms = None
+
+    def __contains__(self, term):
+        return term in self._terms
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __iter__(self):
+        return iter(self._terms)
+
+    def contains(self, term, case_sensitive=True):
+        """True if the term is in the dictionary."""
+        if case_sensitive:
+            return term in self._terms
+        if self._upper_terms is None:
+            # Built on the first case-insensitive lookup only.
+            self._upper_terms = frozenset([t.upper() for t in self._terms])
+        return term.upper() in self._upper_terms
+
+    def get_url(self, term):
+        """Returns the url of a term, or None."""
+        return self._urls.get(term)
+
+    def items(self):
+        """Returns a list of (term, url) tuples sorted by term."""
+        return [(t, self._urls[t]) for t in sorted(self._terms)]
+
+    def starts_with(self, prefix, limit=None):
+        """
+        Returns a list of (term, url) tuples for the terms that start with
+        prefix (case-insensitive), sorted by their upper case version.
+        limit is the max number of tuples to return.
+        """
+        if self._prefix_keys is None:
+            # Built on the first prefix search only: a sorted array of upper
+            # case terms, searched with bisect.
+            pairs = sorted([(t.upper(), t) for t in self._terms])
+            self._prefix_keys = [p[0] for p in pairs]
+            self._prefix_terms = [p[1] for p in pairs]
+        up_prefix = prefix.upper()
+        keys = self._prefix_keys
+        result = []
+        i = bisect_left(keys, up_prefix)
+        while i < len(keys) and keys[i].startswith(up_prefix):
+            if not limit is None and len(result) >= limit:
+                break
+            term = self._prefix_terms[i]
+            result.append((term, self._urls[term]))
+            i += 1
+        return result
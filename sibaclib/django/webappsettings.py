@@ -1,3 +1,6 @@
+import hashlib
+import threading
+import time
 from django.utils import simplejson
 
 class ApplicationPermissions:
@@ -184,3 +187,47 @@ class WebAppSettings:
             dp.default_expression = prm["default_expression"]
             setts.app_permissions.permissions[dp.dt_sid] = dp
         return setts
+
+class WebAppSettingsCache:
+    """Process-local cache of a WebAppSettings instance.
+
+    The settings are created by calling loader, a function without arguments,
+    and kept for ttl seconds. Call invalidate() after saving new settings.
+    Other processes will see the new settings when their copy expires.
+
+    The cached instance is shared: don't modify it. The fingerprint
+    attribute is a SHA-1 of its json representation, that changes when the
+    settings change, and loaded_at the time of the last load.
+
+    Usage:
+
+    cache = WebAppSettingsCache(load_settings, ttl=30)
+    web_app_settings = cache.get()
+    """
+    def __init__(self, loader, ttl=30):
+        """Class constructor."""
+        self.loader = loader
+        self.ttl = ttl
+        self._settings = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self.fingerprint = None
+        self.loaded_at = None
+
+    def get(self):
+        """Returns the cached settings, loading them if they have expired."""
+        with self._lock:
+            now = time.time()
+            if self._settings is None or now >= self._expires:
+                self._settings = self.loader()
+                self._expires = now + self.ttl
+                fingerprint = hashlib.sha1(self._settings.to_json()).hexdigest()
+                if not fingerprint == self.fingerprint:
+                    self.fingerprint = fingerprint
+                    self.loaded_at = now
+            return self._settings
+
+    def invalidate(self):
+        """Drops the cached settings: they will be loaded by the next get()."""
+        with self._lock:
+            self._settings = None
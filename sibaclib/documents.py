@@ -3,22 +3,32 @@ import locale, json, re
 from collections import deque
 from datetime import date, time, datetime
 from decimal import Decimal
-from sibaclib.documenttypes import CatalogationLevel, FieldType, DictionaryType
+from sibaclib.documenttypes import CatalogationLevel, FieldType, DictionaryType, TextFacet
 from sibaclib.errors import *
 from sibaclib.search import *
 
-class Document:
+class Document(object):
     """
     This class represents a single SIBAC document.
 
     This class uses the method json_decode to load the document from a json
     string, and the json_encode to produce a valid json string.
+
+    If use_index is True, the first call to get_contents() builds an index
+    of the contents by complete path, so that the following calls don't
+    walk the content tree. The index is dropped when the content attribute
+    is set, but not when the nested lists of the content are changed in
+    place (i.e. doc.content.append(...)): in that case call invalidate_index()
+    after every change. The default is False, so documents that are edited
+    never return stale contents.
     """
     def __init__(self, dt_sid = "", doc_id = None, package_name = "", author_id = None,
                  author_name = None, creation_date = None, last_edit_date = None,
                  last_editor_id = None, last_editor_name = None,
                  cat_level=CatalogationLevel.NONE,
-                 json_str = "", provider = None, media_files=None):
+                 json_str = "", provider = None, media_files=None, use_index=False):
+        self.use_index = use_index
+        self.content = []
         self.dt_sid = dt_sid
         self.doc_id = doc_id
         self.package_name = package_name
@@ -36,10 +46,52 @@ class Document:
         if media_files is None:
             self.media_files = []
         else:
-            self.media_files = []
+            self.media_files = media_files
         if not len(json_str) == 0:
             self.json_decode(json_str)
 
+    @property
+    def content(self):
+        """The nested [sid, value] lists of the document."""
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._contents_index = None
+
+    def invalidate_index(self):
+        """
+        Drops the contents index. It will be rebuilt when needed.
+
+        If use_index is True, call this method after changing the nested
+        lists of the content in place, otherwise get_contents() can return
+        the contents found before the change.
+        """
+        self._contents_index = None
+
+    def _build_contents_index(self):
+        """
+        Returns a new dictionary that maps the complete path of each element
+        in the document to the list of its values.
+        """
+        index = {}
+        for path, sid, value in self:
+            if path in index:
+                index[path].append(value)
+            else:
+                index[path] = [value]
+        return index
+
+    def _get_contents_index(self):
+        """
+        Same as _build_contents_index(), but the index is kept until the
+        content attribute is set or invalidate_index() is called.
+        """
+        if self._contents_index is None:
+            self._contents_index = self._build_contents_index()
+        return self._contents_index
+
     def json_decode(self, json_str, content_only=True):
         """Decodes the document from a json string."""
         loaded = json.loads(json_str)
@@ -93,21 +145,31 @@ class Document:
         """
         doc_type = self.provider.inspector.doc_types[self.dt_sid]
         complete_path = doc_type.get_complete_paths(element_path, error_if_ambiguous=True)[0]
+        return self._get_contents_at(complete_path)
+
+    def _get_contents_at(self, complete_path):
+        """
+        Same as get_contents(), but complete_path must be the complete path
+        of the element.
+        """
+        if complete_path == self.dt_sid:
+            return self.content
+        if self.use_index:
+            try:
+                return list(self._get_contents_index().get(complete_path, ()))
+            except:
+                return None
         try:
-            path_list = complete_path.split(".")
-            if len(path_list) == 1 and path_list[0] == self.dt_sid:
-                return self.content
-            else:
-                q_path = deque(path_list)
-                # remove the root element, corresponding to the document type name.
-                q_path.popleft()
-                # The next line is necessary to create a consistent algorythm.
-                curr_container = [self.content]
-                while len(q_path) > 0:
-                    curr_sid = q_path.popleft()
-                    # Put nested contents with the specified sid in a new list.
-                    new_container = [g[1] for l in curr_container for g in l if g[0] == curr_sid]
-                    curr_container = new_container
+            q_path = deque(complete_path.split("."))
+            # remove the root element, corresponding to the document type name.
+            q_path.popleft()
+            # The next line is necessary to create a consistent algorythm.
+            curr_container = [self.content]
+            while len(q_path) > 0:
+                curr_sid = q_path.popleft()
+                # Put nested contents with the specified sid in a new list.
+                new_container = [g[1] for l in curr_container for g in l if g[0] == curr_sid]
+                curr_container = new_container
             return curr_container
         except:
             return None
@@ -125,16 +187,40 @@ class Document:
         [1, 2]
         """
         string_contents = self.get_contents(field_path)
-        doc_type = self.provider.inspector.doc_types[self.dt_sid]
         sf = self.provider.inspector.get_element(field_path)
-        extr_rgx = sf.extraction_regex
-        if len(extr_rgx) > 0:
-            matches = [re.search(extr_rgx, x) for x in string_contents]
-            values = [doc_type.get_val_from_text(m.group(0), sf) for m in matches if not m is None]
+        extr_pattern = sf.extraction_pattern
+        if not extr_pattern is None:
+            matches = [extr_pattern.search(x) for x in string_contents]
+            values = [sf.converter(m.group(0)) for m in matches if not m is None]
         else:
-            values = [doc_type.get_val_from_text(x, sf) for x in string_contents]
+            values = [sf.converter(x) for x in string_contents]
         return [v for v in values if not v is None]
 
+    def get_full_texts(self):
+        """
+        Returns a dictionary with the texts of the full_* columns (full_who,
+        full_what, full_where, full_from_where, full_when and full_doc),
+        joining the values of the simple fields that feed each facet (see
+        the text_facets attribute of the document elements).
+
+        All the texts are built with a single walk over the contents, so
+        they can be derived when a document is saved and when many
+        documents are reindexed.
+
+        Usage:
+
+        my_document.get_full_texts()
+        {"full_where": "Italia Marche AN Ancona", "full_doc": "SI I ...", ...}
+        """
+        columns_by_path = self.provider.inspector.doc_types[self.dt_sid].full_text_columns
+        texts = dict([("full_" + f, []) for f in TextFacet.ALL])
+        for path, sid, value in self._flatten(self.content, self.dt_sid):
+            columns = columns_by_path.get(path)
+            if not columns is None:
+                for c in columns:
+                    texts[c].append(value)
+        return dict([(c, " ".join(texts[c])) for c in texts])
+
     def __iter__(self):
         return self._flatten(self.content, self.dt_sid)
 
@@ -162,9 +248,9 @@ class Document:
         Returns None if no error was found, else returns a
         ValidationError instance.
 
-        dictionary is the return value of provider.get_all_terms(dt_sid).
-        If dictionary is none and the field has a closed dictionary, the
-        value will be checked calling provider.check_term(str_value).
+        dictionaries is the return value of provider.get_dictionaries(dt_sid).
+        If dictionaries is None and the field has a closed dictionary, the
+        value will be checked calling provider.check_term(field_path, str_value).
         """
         sf = self.provider.inspector.doc_types[self.dt_sid].simple_fields[field_path]
         val_len = len(str_value)
@@ -188,17 +274,19 @@ class Document:
                 err_msg = "Il testo del campo {0} è troppo" \
                           " lungo.".format(field_path)
                 val_err = ValidationError(err_type, err_msg)
-        if len(sf.validation_regex) > 0 \
-            and not re.match(sf.validation_regex, str_value):
+        if not sf.validation_pattern is None \
+            and not sf.validation_pattern.match(str_value):
             err_type = ValidationErrorType.REGEX_ERR
             err_msg = "Il testo del campo {0} non rispetta il pattern" \
                       " specificato: ".format(field_path) + sf.validation_regex
             val_err = ValidationError(err_type, err_msg)
         if sf.dictionary_type == DictionaryType.CLOSED:
-            if (dictionaries is None \
-                and not self.provider.check_term(str_value)) \
-                or (not field_path in dictionaries or not str_value in dictionaries[field_path]):
-                err_type = ValidationErrorType.WRONG_TEXT_LEN
+            if dictionaries is None:
+                in_dictionary = self.provider.check_term(field_path, str_value)
+            else:
+                in_dictionary = field_path in dictionaries and str_value in dictionaries[field_path]
+            if not in_dictionary:
+                err_type = ValidationErrorType.NOT_IN_DICTIONARY
                 err_msg = "Il valore immesso nel campo {0} non è tra" \
                           " quelli del dizionario chiuso.".format(field_path)
                 val_err = ValidationError(err_type, err_msg)
@@ -217,7 +305,7 @@ class Document:
         # elevato. Se i campi richiesti non sono sufficienti, la scheda scala al livello inferiore.
         result = DocumentValidationResult()
         doc_type = self.provider.inspector.doc_types[self.dt_sid]
-        dictionaries = self.provider.get_all_terms(self.dt_sid)
+        dictionaries = self.provider.get_dictionaries(self.dt_sid)
         prev_path = None
         self.catalogation_level = CatalogationLevel.NONE
         for x in self:
@@ -258,7 +346,10 @@ class Document:
                 result.validation_errors.append(ValidationError(ValidationErrorType.MISSING_FIELD, err_msg))
                 result.can_be_saved = False
         # Assign the right catalogation level
-        all_els_set = set([x[0] for x in self])
+        if self.use_index:
+            all_els_set = set(self._get_contents_index())
+        else:
+            all_els_set = set([x[0] for x in self])
         for level_val in doc_type.required_elements_per_level:
             missing_fields = doc_type.required_elements_per_level[level_val] - all_els_set
             if len(missing_fields) == 0:
@@ -268,75 +359,18 @@ class Document:
         return result
 
     def validate_against_expr(self, search_expr):
+        """
+        Returns True if this document satisfies the WHERE part of a search
+        expression.
+
+        Raises ForStorageOnlyError if the expression uses metafields that
+        can be evaluated only against saved documents. To test many documents,
+        compile the expression once with search_expr.compile(doc_type).
+        """
         if search_expr.for_storage_only():
             raise ForStorageOnlyError()
-        return self._evaluate_condition_group(search_expr.where.conditions)
-
-    def _evaluate_condition_group(self, conditions):
-        # Each element of bools is a tuple: (bool_op, bool_val),
-        # i.e. [(None, False), (BooleanOperator.AND, True)]
-        bools = []
-        for c in conditions:
-            if hasattr(c, "conditions"):
-                b_tuple = (c.bool_op, self._evaluate_condition_group(c.conditions))
-            else:
-                b_tuple = (c.bool_op, self._evaluate_condition(c))
-            bools.append(b_tuple)
-        result = None
-        for t in bools:
-            if result is None:
-                # the boolean operator of the first tuple is not considered:
-                # it must be None.
-                result = t[1] if t[0] is not BooleanOperator.NOT else not t[0]
-            else:
-                op = t[0]
-                if op == BooleanOperator.AND:
-                    result = result and t[1]
-                elif op == BooleanOperator.OR:
-                    result = result or t[1]
-                elif op == BooleanOperator.AND_NOT:
-                    result = result and not t[1]
-                elif op == BooleanOperator.OR_NOT:
-                    result = result or not t[1]
-        return result
-            
-    def _evaluate_condition(self, condition):
-        field_path = condition.field
-        field_vals = None
-        op = condition.comp_op
-        comp_val = condition.compare_to
         doc_type = self.provider.inspector.doc_types[self.dt_sid]
-        complete_path = doc_type.get_complete_paths(pure_path, error_if_ambiguous=True)[0]
-        if field_path.endswith("._as_value"):
-            simple_field = doc_type.simple_fields[complete_path]
-            comp_val = doc_type.get_val_from_text(comp_val, simple_field)
-            field_vals = self.get_contents_as_values(complete_path)
-        elif field_path.endswith("._package_name"):
-            field_vals = [self.package_name]
-        elif field_path.endswith("._count"):
-            field_vals = [len(self.get_contents(complete_path))]
-            comp_val = int(comp_val)
-        elif field_path.endswith("._author_id"):
-            field_vals = [self.author_id]
-        else:
-            field_vals = self.get_contents(complete_path)
-        if op == ComparisonOperator.EQUAL:
-            if isinstance(comp_val, basestring):
-                #String comparison is case-insensitive.
-                field_vals = [x.upper() for x in field_vals]
-                comp_val = comp_val.upper()
-            def comp(field_val, comp_val): return field_val == comp_val
-        elif op == ComparisonOperator.LESSER:
-            def comp(field_val, comp_val): return field_val < comp_val
-        elif op == ComparisonOperator.GREATER:
-            def comp(field_val, comp_val): return field_val > comp_val
-        elif op == ComparisonOperator.LESSER_OR_EQUAL:
-            def comp(field_val, comp_val): return field_val <= comp_val
-        elif op == ComparisonOperator.GREATER_OR_EQUAL:
-            def comp(field_val, comp_val): return field_val >= comp_val
-        elif op == ComparisonOperator.LIKE:
-            def comp(field_val, comp_val): return comp_val.upper() in field_val.upper()
-        return any([comp(x, comp_val) for x in field_vals])
+        return search_expr.compile(doc_type)(self)
 
 class DocumentValidationResult:
     """
@@ -1,8 +1,16 @@
-from datetime import date
+from datetime import date, datetime
+from decimal import Decimal
 from collections import OrderedDict
 import locale
+import re
+import string
 from sibaclib.errors import *
 
+# Version of the structure built by DocumentType.from_dict(). Increase it
+# every time that structure changes, so that the document types compiled
+# by DocumentTypesInspector are rebuilt.
+COMPILED_FORMAT_VERSION = 7
+
 class FieldType:
     """
     This class is used to specify the data type for an ICCD field.
@@ -69,6 +77,27 @@ class MediaType:
     SOUND = 2
     MOVIE = 3
 
+class TextFacet:
+    """
+    This class is used to specify which full text facets are fed by the
+    values of a paragraph or field. Every facet is stored in the full_*
+    column of the same name (i.e. full_where).
+
+    DOC is fed by every simple field, so it doesn't need to be specified.
+
+    Example:
+    p = Paragraph()
+    p.sid = "LC"
+    p.text_facets = (TextFacet.WHERE,)
+    """
+    WHO = "who"
+    WHAT = "what"
+    WHERE = "where"
+    FROM_WHERE = "from_where"
+    WHEN = "when"
+    DOC = "doc"
+    ALL = (WHO, WHAT, WHERE, FROM_WHERE, WHEN, DOC)
+
 class ElementBase(object):
     """
     This class defines the attributes shared bu every document and every element
@@ -101,6 +130,10 @@ class DocumentType(ElementBase):
     ext_extension:     Extension of Extension of the files exported, if they contain
                        also non-compliant fields.
     paragraphs:        A list of Paragraph instances.
+    schema_hash:       SHA-1 of the model file that defines the document type.
+                       It changes every time the definition changes.
+    full_text_columns: For each simple field path, the full_* columns that its
+                       values are added to (see TextFacet).
     """
 
     def __init__(self):
@@ -112,12 +145,18 @@ class DocumentType(ElementBase):
         self.std_extension = ""
         self.ext_extension = ""
         self.public_by_default = False
+        self.schema_hash = ""
         self.paragraphs = []
         self.all_elements = OrderedDict()
         self.simple_fields = OrderedDict()
         self.multimedia_fields = OrderedDict()
         self.required_fields = OrderedDict()
         self.required_elements_per_level = OrderedDict()
+        self.element_ordinals = {}
+        self.repeatable_ancestors = {}
+        self.ancestor_sids = {}
+        self.paths_by_suffix = {}
+        self.full_text_columns = {}
 
     @staticmethod
     def from_dict(values_dict):
@@ -263,6 +302,8 @@ class DocumentType(ElementBase):
                 self.update_all_elements_attribute(p, req_dict=req_dict)
             for k in req_dict:
                 self.required_elements_per_level[k] = set(req_dict[k])
+            self._update_ordering_tables()
+            self._update_paths_by_suffix()
         else:
             self.all_elements[current_element.complete_path] = current_element
             if not current_element.level == CatalogationLevel.NONE:
@@ -271,13 +312,63 @@ class DocumentType(ElementBase):
                 for f in current_element.fields:
                     self.update_all_elements_attribute(f, req_dict=req_dict)
 
+    def _update_ordering_tables(self):
+        """
+        Updates the tables used by can_be_preceded():
+
+        element_ordinals:     the position of each element path in all_elements.
+        repeatable_ancestors: for each element path, the sids of the repeatable
+                              elements among the element itself and the
+                              paragraphs and structured fields containing it.
+        ancestor_sids:        for each element path, the sids of the elements
+                              containing it (the document type excluded).
+        """
+        self.element_ordinals.clear()
+        self.repeatable_ancestors.clear()
+        self.ancestor_sids.clear()
+        for i, el_key in enumerate(self.all_elements):
+            self.element_ordinals[el_key] = i
+            rep_sids = set()
+            el = self.all_elements[el_key]
+            if hasattr(el, "fields") and el.repeatable:
+                # A repeated paragraph or structured field can follow
+                # its own contents.
+                rep_sids.add(el.sid)
+            p_el = el.parent_element
+            while hasattr(p_el, "repeatable"):
+                if p_el.repeatable:
+                    rep_sids.add(p_el.sid)
+                p_el = p_el.parent_element
+            self.repeatable_ancestors[el_key] = frozenset(rep_sids)
+            self.ancestor_sids[el_key] = frozenset(el_key.split('.')[1:-1])
+
+    def _update_paths_by_suffix(self):
+        """
+        Updates the paths_by_suffix attribute, used by get_complete_paths().
+
+        Every sid and every partial path of an element (i.e. "NCTN",
+        "NCT.NCTN", "CD.NCT.NCTN" and "SI.CD.NCT.NCTN") is mapped to the list
+        of complete paths ending with it.
+        """
+        self.paths_by_suffix.clear()
+        for el_key in self.all_elements:
+            parts = el_key.split('.')
+            for i in range(len(parts)):
+                suffix = '.'.join(parts[i:])
+                if suffix in self.paths_by_suffix:
+                    self.paths_by_suffix[suffix].append(el_key)
+                else:
+                    self.paths_by_suffix[suffix] = [el_key]
+
     def update_simple_fields_attribute(self):
         """
-        Updates the simple_fields and the "multimedia_fields" attributes.
+        Updates the simple_fields, "multimedia_fields" and "full_text_columns"
+        attributes.
         """
         self.simple_fields.clear()
         self.multimedia_fields.clear()
         self.required_fields.clear()
+        self.full_text_columns.clear()
         all_elem = self.all_elements
         for el_key in all_elem:
             curr_el = all_elem[el_key]
@@ -287,6 +378,31 @@ class DocumentType(ElementBase):
                     self.multimedia_fields[el_key] = curr_el
                 if curr_el.required_for_saving:
                     self.required_fields[el_key] = curr_el
+                curr_el.compile_regexes()
+                curr_el.compile_converter()
+                self.full_text_columns[el_key] = self._get_full_text_columns(curr_el)
+
+    def _get_full_text_columns(self, simple_field):
+        """
+        Returns a tuple with the full_* columns fed by a simple field: the
+        ones of the facets declared by the field and by the paragraph and
+        structured fields containing it, and full_doc.
+
+        Raises SchemaDefinitionError if a facet doesn't exist.
+        """
+        facets = set([TextFacet.DOC])
+        el = simple_field
+        while hasattr(el, "text_facets"):
+            el_facets = el.text_facets
+            if isinstance(el_facets, basestring):
+                el_facets = (el_facets,)
+            for f in el_facets:
+                if not f in TextFacet.ALL:
+                    msg = "'{0}' is not a valid text facet.".format(f)
+                    raise SchemaDefinitionError(el.complete_path, msg)
+            facets.update(el_facets)
+            el = el.parent_element
+        return tuple(["full_" + f for f in TextFacet.ALL if f in facets])
 
     def can_be_preceded(self, element_path, prev_element_path):
         """
@@ -294,9 +410,8 @@ class DocumentType(ElementBase):
         can be immediately preceded by the element specified by
         the prev_element_path parameter.
         """
-        keys = self.all_elements.keys()
-        ind_el = keys.index(element_path)
-        ind_prev = keys.index(prev_element_path)
+        ind_el = self.element_ordinals[element_path]
+        ind_prev = self.element_ordinals[prev_element_path]
         if ind_el > ind_prev:
             return True
         elif ind_el == ind_prev:
@@ -308,18 +423,10 @@ class DocumentType(ElementBase):
             else:
                 return False
         else: # ind_el < ind_prev
-            # Test if there is a repetition.
-            p_el = self.all_elements[element_path].parent_element
-            # Split the previous element path and remove the first and the
-            # last entries, respectively the document type sid and the field sid.
-            splitted_prev = prev_element_path.split('.')[1:-1]
-            test_passed = False
-            while hasattr(p_el, "repeatable"):
-                if p_el.repeatable and p_el.sid in splitted_prev:
-                    test_passed = True
-                    break
-                p_el = p_el.parent_element
-            return test_passed
+            # Test if there is a repetition: a repeatable element containing
+            # element_path must also contain the previous element.
+            return not self.repeatable_ancestors[element_path].isdisjoint(
+                self.ancestor_sids[prev_element_path])
 
     def get_complete_paths(self, element_path, error_if_ambiguous):
         """Returns a list of paths of one or more elements, knowing
@@ -329,8 +436,7 @@ class DocumentType(ElementBase):
             pure_path = element_path[:element_path.index("._")]
         else:
             pure_path = element_path
-        paths = [k for k in self.all_elements if k == pure_path or \
-            k.endswith("." + pure_path)]
+        paths = list(self.paths_by_suffix.get(pure_path, ()))
         if self.sid == pure_path:
             paths.append(self.sid)
         if error_if_ambiguous:
@@ -349,67 +455,73 @@ class DocumentType(ElementBase):
         
         Returns None if the cast fails.
         """
-        ft = simple_field.field_type
-        en = simple_field.english_notation
-        try:
-            if ft == FieldType.BOOLEAN:
-                return_val = bool(str_val)
-            elif ft == FieldType.BYTE:
-                return_val = int(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.INT16:
-                return_val = int(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.INT32:
-                return_val = int(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.INT64:
-                return_val = long(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.SINGLE:
-                return_val = float(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.DOUBLE:
-                return_val = float(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.DECIMAL:
-                return_val = Decimal(self._replace_decimal_signs(str_val, en))
-            elif ft == FieldType.DATE:
-                if len(simple_field.datetime_format) > 0:
-                    return_val = date.strptime(str_val, simple_field.datetime_format)
-                else:
-                    return_val = date.strptime(str_val)
-            elif ft == FieldType.TIME:
-                if len(simple_field.datetime_format) > 0:
-                    return_val = time.strptime(str_val, simple_field.datetime_format)
-                else:
-                    return_val = time.strptime(str_val)
-            elif ft == FieldType.DATETIME:
-                if len(simple_field.datetime_format) > 0:
-                    return_val = date.strptime(str_val, simple_field.datetime_format).date()
-                else:
-                    return_val = date.strptime(str_val).date()
-            elif ft == FieldType.STRING:
-                return_val = str_val
-        except:
-                return_val = None
-        return return_val
-
-    def _replace_decimal_signs(self, str_val, use_english_notation):
-        """
-        Returns a string that can be passed to int(), float() etc.
+        return simple_field.converter(str_val)
 
-        This method examinate the local settings and the value
-        of the use_english_notation parameter to create a string that
-        should not raise exception during the conversion to a numeric
-        format.
-        """
+# Translation tables used to swap commas and points in numeric values.
+_DECIMAL_SIGNS_STR = string.maketrans(",.", ".,")
+_DECIMAL_SIGNS_UNICODE = {ord(u","): u".", ord(u"."): u","}
+
+def _swap_decimal_signs(str_val):
+    """Swaps commas and points in a string."""
+    if isinstance(str_val, unicode):
+        return str_val.translate(_DECIMAL_SIGNS_UNICODE)
+    else:
+        return str_val.translate(_DECIMAL_SIGNS_STR)
+
+def _compile_converter(simple_field):
+    """
+    Returns a function that converts a text to a value of the type
+    specified by the field_type attribute of simple_field, or None if the
+    cast fails.
+
+    The locale and the english_notation attribute are examined here once,
+    so the returned function only has to cast the text.
+    """
+    ft = simple_field.field_type
+    if ft == FieldType.STRING:
+        return lambda str_val: str_val
+    elif ft == FieldType.BOOLEAN:
+        cast = bool
+    elif ft in _NUMERIC_CASTS:
+        num_cast = _NUMERIC_CASTS[ft]
         lc_using_point = locale.localeconv()["decimal_point"] == "."
-        if use_english_notation:
-            if lc_using_point:
-                result = str_val
-            else:
-                result = str_val.replace(",", "_").replace(".", ",").replace("_", ".")
+        if bool(simple_field.english_notation) == lc_using_point:
+            cast = num_cast
         else:
-            if lc_using_point:
-                result = str_val.replace(",", "_").replace(".", ",").replace("_", ".")
-            else:
-                result = str_val
-        return result
+            cast = lambda str_val: num_cast(_swap_decimal_signs(str_val))
+    else:
+        dt_format = simple_field.datetime_format
+        if len(dt_format) == 0:
+            dt_format = _DEFAULT_DATETIME_FORMATS[ft]
+        if ft == FieldType.DATE:
+            cast = lambda str_val: datetime.strptime(str_val, dt_format).date()
+        elif ft == FieldType.TIME:
+            cast = lambda str_val: datetime.strptime(str_val, dt_format).time()
+        else:
+            cast = lambda str_val: datetime.strptime(str_val, dt_format)
+    def converter(str_val):
+        try:
+            return cast(str_val)
+        except Exception:
+            return None
+    return converter
+
+_NUMERIC_CASTS = {
+                     FieldType.BYTE: int,
+                     FieldType.INT16: int,
+                     FieldType.INT32: int,
+                     FieldType.INT64: long,
+                     FieldType.SINGLE: float,
+                     FieldType.DOUBLE: float,
+                     FieldType.DECIMAL: Decimal,
+                 }
+
+# Formats used for date and time fields with an empty datetime_format.
+_DEFAULT_DATETIME_FORMATS = {
+                                FieldType.DATE: "%Y-%m-%d",
+                                FieldType.TIME: "%H:%M:%S",
+                                FieldType.DATETIME: "%Y-%m-%d %H:%M:%S",
+                            }
 
 class DocumentElementBase(ElementBase):
     """
@@ -425,12 +537,17 @@ class DocumentElementBase(ElementBase):
                     validating the document.
                     Use the CatalogationLevel attributes to specify the values.
     parent_element: The parent element in the document type tree.
+    text_facets:    The full text facets fed by the values of the element, as a
+                    tuple of TextFacet attributes. The facets of a paragraph or
+                    structured field are fed by all the fields it contains.
+                    The default value is () (only the DOC facet).
     """
     def __init__(self):
         super(DocumentElementBase, self).__init__()
         self.repeatable = False
         self.level = CatalogationLevel.NONE
         self.parent_element = None
+        self.text_facets = ()
 
 class SimpleField(DocumentElementBase):
     """
@@ -464,6 +581,12 @@ class SimpleField(DocumentElementBase):
                          more fields, set unique=True for all the fields and set the
                          uniqueness_group to the same integer value. Default is 0 (no
                          group).
+
+    converter:           A function that converts a text to a value of the type
+                         specified by field_type, returning None if the cast fails.
+                         It is set by compile_converter().
+    validation_pattern:  validation_regex compiled by compile_regexes(), or None.
+    extraction_pattern:  extraction_regex compiled by compile_regexes(), or None.
     """
     def __init__(self):
         super(SimpleField, self).__init__()
@@ -479,6 +602,41 @@ class SimpleField(DocumentElementBase):
         self.media_type = MediaType.NONE
         self.unique = False
         self.uniqueness_group = 0
+        self.converter = None
+        self.validation_pattern = None
+        self.extraction_pattern = None
+
+    def compile_regexes(self):
+        """
+        Sets the validation_pattern and extraction_pattern attributes.
+
+        Raises SchemaDefinitionError if a regular expression is not valid.
+        """
+        self.validation_pattern = self._compile_regex(self.validation_regex, "validation_regex")
+        self.extraction_pattern = self._compile_regex(self.extraction_regex, "extraction_regex")
+
+    def _compile_regex(self, regex, attr_name):
+        if len(regex) == 0:
+            return None
+        try:
+            return re.compile(regex)
+        except re.error as e:
+            msg = "{0} '{1}' is not a valid regular expression ({2}).".format(attr_name, regex, e)
+            raise SchemaDefinitionError(getattr(self, "complete_path", self.sid), msg)
+
+    def compile_converter(self):
+        """Sets the converter attribute according to the field definition."""
+        self.converter = _compile_converter(self)
+
+    def __getstate__(self):
+        # Compiled converters can't be pickled: they are rebuilt on loading.
+        state = self.__dict__.copy()
+        state["converter"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile_converter()
 
 class FieldsContainerBase(DocumentElementBase):
     """
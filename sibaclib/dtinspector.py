@@ -1,24 +1,82 @@
 import glob
+import hashlib
+import os
 import os.path
 import imp
 from collections import deque
 from sibaclib.documenttypes import *
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Name of the folder, created inside the document types folder, that contains
+# the compiled document types.
+CACHE_FOLDER_NAME = "__sibaccache__"
 
 class DocumentTypesInspector:
-    def __init__(self, document_types_folder):
+    def __init__(self, document_types_folder, use_cache=True):
+        # Loads all the document types defined in the folder.
+        #
+        # If use_cache is True, every DocumentType built from a model file is
+        # saved in CACHE_FOLDER_NAME and reused until the model file changes.
         self.doc_types = {}
+        self.cache_folder = os.path.join(document_types_folder, CACHE_FOLDER_NAME)
         search_path = os.path.join(document_types_folder, "*.py")
         files = glob.glob(search_path)
         for a_file in files:
             f_name = os.path.basename(a_file)
             if not f_name.startswith("__"):
-                mod_name = os.path.splitext(f_name)
-                #imp_mod = imp.load_source(f_name, a_file)
-                imp_mod = imp.load_source('', a_file)
-                if hasattr(imp_mod, "document_type_def"):
-                    dt = DocumentType.from_dict(imp_mod.document_type_def)
+                with open(a_file, "rb") as f:
+                    schema_hash = hashlib.sha1(f.read()).hexdigest()
+                mtime = os.path.getmtime(a_file)
+                cache_file = os.path.join(self.cache_folder, os.path.splitext(f_name)[0] + ".dtcache")
+                dt = None
+                if use_cache:
+                    dt = self._load_compiled(cache_file, schema_hash, mtime)
+                if dt is None:
+                    #imp_mod = imp.load_source(f_name, a_file)
+                    imp_mod = imp.load_source('', a_file)
+                    if hasattr(imp_mod, "document_type_def"):
+                        dt = DocumentType.from_dict(imp_mod.document_type_def)
+                        dt.schema_hash = schema_hash
+                        if use_cache:
+                            self._save_compiled(cache_file, dt, mtime)
+                if not dt is None:
                     self.doc_types[dt.sid] = dt
 
+    def _load_compiled(self, cache_file, schema_hash, mtime):
+        # Returns the DocumentType stored in cache_file, or None if the file
+        # doesn't exist, can't be read or was compiled from a different
+        # version of the model file.
+        try:
+            with open(cache_file, "rb") as f:
+                header = pickle.load(f)
+                if not header == (COMPILED_FORMAT_VERSION, schema_hash, mtime):
+                    return None
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _save_compiled(self, cache_file, doc_type, mtime):
+        # Writes the compiled DocumentType. The header is pickled separately,
+        # so that stale files can be detected without loading the whole
+        # structure. Failures are ignored: the cache is only an optimization.
+        tmp_file = cache_file + ".{0}.tmp".format(os.getpid())
+        try:
+            if not os.path.isdir(self.cache_folder):
+                os.makedirs(self.cache_folder)
+            with open(tmp_file, "wb") as f:
+                header = (COMPILED_FORMAT_VERSION, doc_type.schema_hash, mtime)
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(doc_type, f, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(cache_file):
+                os.remove(cache_file)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError, pickle.PicklingError):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
     def get_element(self, element_path):
         # Returns a field, paragraph or document type definition.
         #
@@ -29,3 +29,23 @@ class AmbiguousElementPath(SearchExpressionError):
 
     def __str__(self):
         return unicode(element_path).encode("utf-8")
+
+class ProviderError(Exception):
+    """Generic error raised by a SIBAC provider."""
+    pass
+
+class PoolTimeoutError(ProviderError):
+    """No pooled connection became available in the allowed time."""
+    pass
+
+class SchemaDefinitionError(Exception):
+    """The definition of a document type element is not valid."""
+    def __init__(self, element_path, message):
+        self.element_path = element_path
+        self.message = message
+
+    def __unicode__(self):
+        return u"{0}: {1}".format(self.element_path, self.message)
+
+    def __str__(self):
+        return unicode(self).encode("utf-8")
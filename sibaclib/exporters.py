@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import csv
+from cStringIO import StringIO
+
+class DocumentsWriter(object):
+    """
+    Base class of the exporters.
+
+    An exporter converts documents to text one document at a time, so the
+    documents can come from a generator (i.e. provider.iter_documents())
+    and the output can be written to a file or returned as the iterable
+    content of an HTTP response, with bounded memory.
+    """
+    def __init__(self, provider, dt_sid):
+        """Class constructor."""
+        self.provider = provider
+        self.doc_type = provider.inspector.doc_types[dt_sid]
+
+    def iter_chunks(self, documents=None):
+        """
+        Returns a generator of encoded strings, one for each document (the
+        first one can also contain a header). If documents is None, all the
+        documents of the document type are read from the provider.
+        """
+        if documents is None:
+            documents = self.provider.iter_documents(self.doc_type.sid)
+        header = self._get_header()
+        if header:
+            yield header
+        for doc in documents:
+            yield self._document_to_text(doc)
+
+    def write(self, out, documents=None):
+        """
+        Writes the documents to out, a file-like object opened in binary
+        mode. Returns the number of documents written.
+
+        Usage:
+
+        with open("export." + writer.get_file_extension(), "wb") as f:
+            writer.write(f)
+        """
+        if documents is None:
+            documents = self.provider.iter_documents(self.doc_type.sid)
+        out.write(self._get_header())
+        count = 0
+        for doc in documents:
+            out.write(self._document_to_text(doc))
+            count += 1
+        return count
+
+    def get_file_extension(self):
+        """Returns the extension of the exported files."""
+        raise NotImplementedError()
+
+    def _get_header(self):
+        return ""
+
+    def _document_to_text(self, doc):
+        raise NotImplementedError()
+
+class TrcWriter(DocumentsWriter):
+    """
+    Exports documents in the ICCD exchange format (TRC): one "SID: value"
+    line for each simple field and one "SID:" line for each paragraph or
+    structured field.
+
+    If compliant_only is True, the elements that are not part of the ICCD
+    standard (compliant is False) are left out, together with their
+    contents, and the file extension is the std_extension of the document
+    type; otherwise it's the ext_extension.
+
+    Usage:
+
+    writer = TrcWriter(provider, "SI", compliant_only=True)
+    response = HttpResponse(writer.iter_chunks(), mimetype="text/plain")
+    """
+    def __init__(self, provider, dt_sid, compliant_only=False, encoding="cp1252"):
+        """Class constructor."""
+        super(TrcWriter, self).__init__(provider, dt_sid)
+        self.compliant_only = compliant_only
+        self.encoding = encoding
+        self._excluded_paths = set()
+        if compliant_only:
+            for path, el in self.doc_type.all_elements.iteritems():
+                parent_path = path[:path.rindex(".")]
+                if not el.compliant or parent_path in self._excluded_paths:
+                    self._excluded_paths.add(path)
+
+    def get_file_extension(self):
+        if self.compliant_only:
+            return self.doc_type.std_extension or "trc"
+        else:
+            return self.doc_type.ext_extension or "trc"
+
+    def _document_to_text(self, doc):
+        lines = []
+        excluded = self._excluded_paths
+        for path, sid, value in doc:
+            if path in excluded:
+                continue
+            if isinstance(value, basestring):
+                lines.append(sid + ": " + value)
+            else:
+                lines.append(sid + ":")
+        lines.append("")
+        return "\r\n".join(lines).encode(self.encoding, "replace")
+
+class CsvWriter(DocumentsWriter):
+    """
+    Exports documents as CSV (utf-8), with a column for the document id
+    and a column for each simple field of the document type, named after
+    its complete path. The values of repeated fields are joined by
+    repetition_separator.
+
+    Usage:
+
+    with open("export.csv", "wb") as f:
+        CsvWriter(provider, "SI").write(f)
+    """
+    def __init__(self, provider, dt_sid, delimiter=";", repetition_separator=" | "):
+        """Class constructor."""
+        super(CsvWriter, self).__init__(provider, dt_sid)
+        self.delimiter = delimiter
+        self.repetition_separator = repetition_separator
+        self._columns = list(self.doc_type.simple_fields)
+
+    def get_file_extension(self):
+        return "csv"
+
+    def _get_row_text(self, row):
+        buf = StringIO()
+        csv.writer(buf, delimiter=self.delimiter).writerow(
+            [v.encode("utf-8") if isinstance(v, unicode) else v for v in row])
+        return buf.getvalue()
+
+    def _get_header(self):
+        return self._get_row_text(["id"] + self._columns)
+
+    def _document_to_text(self, doc):
+        row = [doc.doc_id]
+        index = doc._build_contents_index()
+        for path in self._columns:
+            values = index.get(path, [])
+            row.append(self.repetition_separator.join(values))
+        return self._get_row_text(row)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import codecs
+import re
+from sibaclib.documents import Document
+
+# A TRC line: "SID: value" or "SID:" for paragraphs and structured fields.
+_TRC_LINE = re.compile(r'^([A-Z][A-Z0-9]*):\s?(.*)$')
+
+class TrcReader(object):
+    """
+    Reads the documents of an ICCD exchange file (TRC format).
+
+    In a TRC file each line contains an element and its value, i.e.
+    "NCTN: 00000001"; paragraphs and structured fields have no value,
+    i.e. "CD:". Lines that don't start with a sid continue the value of
+    the previous simple field.
+
+    The file is read line by line: the nested content of each record is
+    rebuilt using the element index of the document type, and a Document
+    is yielded as soon as the next record starts. A new record starts
+    when an element of the first level can't follow the previous one
+    (i.e. a second "CD:" paragraph). Lines that precede the first record
+    are ignored.
+
+    Usage:
+
+    reader = TrcReader(provider, "SI", package_name="pkg1")
+    for doc in reader.read("/path/to/file.trc"):
+        print doc.get_contents("NCTN")
+    """
+    def __init__(self, provider, dt_sid, package_name="", encoding="cp1252"):
+        """Class constructor."""
+        self.provider = provider
+        self.doc_type = provider.inspector.doc_types[dt_sid]
+        self.package_name = package_name
+        self.encoding = encoding
+
+    def read(self, trc_file):
+        """
+        Returns a generator of Document instances. trc_file can be a file
+        name or a file object opened in binary mode.
+        """
+        if isinstance(trc_file, basestring):
+            with open(trc_file, "rb") as f:
+                for doc in self._read_lines(f):
+                    yield doc
+        else:
+            for doc in self._read_lines(trc_file):
+                yield doc
+
+    def _read_lines(self, f):
+        """Parses the lines of a file and yields the documents."""
+        doc_type = self.doc_type
+        root = doc_type.sid
+        content = None
+        # Each element of the stack is a tuple (complete_path, list of children).
+        stack = []
+        prev_path = None
+        last_field = None
+        for line in codecs.getreader(self.encoding)(f):
+            line = line.rstrip("\r\n")
+            if len(line.strip()) == 0:
+                continue
+            match = _TRC_LINE.match(line)
+            path = None
+            if not match is None:
+                path = self._get_path(match.group(1), stack)
+            if path is None:
+                if match is None:
+                    # A continuation line.
+                    if not last_field is None:
+                        last_field[1] += "\n" + line
+                elif len(stack) > 0:
+                    # Keep unknown elements: validation will report them.
+                    last_field = [match.group(1), match.group(2)]
+                    stack[-1][1].append(last_field)
+                continue
+            is_first_level = path.count(".") == 1
+            if content is None or (is_first_level and not doc_type.can_be_preceded(path, prev_path)):
+                if not content is None:
+                    yield self._create_document(content)
+                content = []
+                stack = [(root, content)]
+            parent_path = path[:path.rindex(".")]
+            while not stack[-1][0] == parent_path:
+                stack.pop()
+            sid = match.group(1)
+            if path in doc_type.simple_fields:
+                last_field = [sid, match.group(2)]
+                stack[-1][1].append(last_field)
+            else:
+                last_field = None
+                children = []
+                stack[-1][1].append([sid, children])
+                stack.append((path, children))
+            prev_path = path
+        if not content is None:
+            yield self._create_document(content)
+
+    def _get_path(self, sid, stack):
+        """
+        Returns the complete path of an element, choosing the one contained
+        in the deepest element of the stack, or in the document type if
+        the element starts a new paragraph. Returns None if the element
+        doesn't exist.
+        """
+        paths = self.doc_type.paths_by_suffix.get(sid)
+        if paths is None:
+            return None
+        if len(stack) == 0:
+            # Waiting for the first record: only paragraphs are accepted.
+            root_prefix = self.doc_type.sid + "."
+            first_level = [p for p in paths if p.startswith(root_prefix) and p.count(".") == 1]
+            return first_level[0] if len(first_level) > 0 else None
+        for container_path, children in reversed(stack):
+            for p in paths:
+                if p[:p.rindex(".")] == container_path:
+                    return p
+        return None
+
+    def _create_document(self, content):
+        """Creates a Document with the content of a record."""
+        doc = Document(dt_sid=self.doc_type.sid, package_name=self.package_name,
+                       provider=self.provider)
+        doc.content = content
+        return doc
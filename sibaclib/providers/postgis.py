@@ -1,7 +1,287 @@
+# -*- coding: utf-8 -*-
 import imp
+import itertools
+import json
 import os
+import threading
+import time
 import psycopg2
-from sibaclib.documenttypes import FieldType
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import date, time as dt_time, datetime
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, ISOLATION_LEVEL_AUTOCOMMIT
+from sibaclib.documenttypes import FieldType, TextFacet
+from sibaclib.dictionaries import TermsDictionary
+from sibaclib.documents import Document
+from sibaclib.errors import PoolTimeoutError, ProviderError, SearchExpressionError
+from sibaclib.search import SearchExpression, BooleanOperator, ComparisonOperator
+
+class ConnectionPool:
+    """
+    A thread-safe pool of psycopg2 connections.
+
+    Connections are checked out with getconn() and must be given back with
+    putconn(). When max_size connections are already in use, getconn() waits
+    until another thread returns one, or raises PoolTimeoutError after
+    timeout seconds.
+
+    Before a connection is handed out again, the pool verifies that it's
+    still open and idle. If the connection has been idle for more than
+    ping_after seconds, a "SELECT 1" is also sent to the server. Broken
+    connections are discarded and replaced by new ones.
+
+    The pool can be inherited by a forked process (e.g. a multiprocessing
+    worker or a preforking web server). A child process never uses nor
+    closes the connections opened by its parent, since they share the
+    same sockets: the first call made in the child forgets them and the
+    pool starts again with new connections.
+    """
+
+    def __init__(self, connection_string, min_size=0, max_size=10,
+                 timeout=30, ping_after=30):
+        """Class constructor"""
+        self._connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._idle = []        # A list of (connection, last_used) tuples.
+        self._size = 0         # Open connections, both idle and in use.
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {"created": 0, "reused": 0, "discarded": 0,
+                       "checkouts": 0, "waits": 0}
+        self._pid = os.getpid()
+        self._owned = set()    # Ids of the connections opened by this process.
+        self._inherited = []   # Connections opened by the parent process.
+        for i in range(min_size):
+            conn = psycopg2.connect(connection_string)
+            self._idle.append((conn, time.time()))
+            self._owned.add(id(conn))
+            self._size += 1
+            self._stats["created"] += 1
+
+    def _check_pid(self):
+        """
+        Resets the pool if the current process is a fork of the one that
+        created the connections.
+
+        The inherited connections are kept referenced but never closed:
+        closing them (or letting the garbage collector do it) would end the
+        sessions that the parent process is still using. The lock is
+        replaced as well, since it could have been held by a thread that
+        doesn't exist in the child.
+        """
+        if self._pid == os.getpid():
+            return
+        self._cond = threading.Condition(threading.Lock())
+        with self._cond:
+            self._inherited.extend(conn for conn, last_used in self._idle)
+            self._idle = []
+            self._owned = set()
+            self._size = 0
+            self._in_use = 0
+            self._pid = os.getpid()
+
+    def _is_healthy(self, conn, last_used):
+        """True if the connection can be safely reused."""
+        if conn.closed:
+            return False
+        if not conn.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+            return False
+        if time.time() - last_used > self.ping_after:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        """Closes a connection and frees its slot in the pool."""
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._owned.discard(id(conn))
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Checks out a connection from the pool."""
+        self._check_pid()
+        deadline = time.time() + self.timeout
+        with self._cond:
+            self._stats["checkouts"] += 1
+        while True:
+            conn = None
+            with self._cond:
+                while len(self._idle) == 0 and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError("No database connection available"
+                                               " after {0} seconds.".format(self.timeout))
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                if len(self._idle) > 0:
+                    conn, last_used = self._idle.pop()
+                else:
+                    # Reserve a slot, the connection is opened outside the lock.
+                    self._size += 1
+            if conn is None:
+                try:
+                    conn = psycopg2.connect(self._connection_string)
+                except:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._owned.add(id(conn))
+                    self._stats["created"] += 1
+                    self._in_use += 1
+                return conn
+            elif self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats["reused"] += 1
+                    self._in_use += 1
+                return conn
+            else:
+                self._discard(conn)
+
+    def putconn(self, conn):
+        """Returns a connection to the pool."""
+        self._check_pid()
+        with self._cond:
+            if not id(conn) in self._owned:
+                # Checked out by the parent process before the fork: it
+                # isn't counted by this pool and must be left open.
+                self._inherited.append(conn)
+                return
+        if not conn.closed and not conn.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+            # The caller failed before committing: don't leave an open
+            # transaction on the connection.
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        with self._cond:
+            self._in_use -= 1
+            if not conn.closed:
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def closeall(self):
+        """Closes all the idle connections."""
+        self._check_pid()
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+        for conn, last_used in idle:
+            self._discard(conn)
+
+    def get_stats(self):
+        """Returns a dictionary describing the pool usage."""
+        self._check_pid()
+        with self._cond:
+            stats = dict(self._stats)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+            stats["in_use"] = self._in_use
+            stats["idle"] = len(self._idle)
+            return stats
+
+class BulkIngestResult:
+    """
+    Instances of this class are returned by SibacProvider.bulk_ingest().
+
+    Attributes:
+
+    doc_ids:     The ids of the inserted documents, in input order.
+    errors:      A list of tuples (index, messages) for the documents that
+                 have not been inserted. index is the position of the
+                 document in the input sequence, messages a list of strings.
+                 The documents themselves are not kept, so that a large load
+                 with many rejected documents doesn't fill the memory.
+    """
+    def __init__(self):
+        self.doc_ids = []
+        self.errors = []
+
+    @property
+    def inserted_count(self):
+        return len(self.doc_ids)
+
+class SearchTableDiff:
+    """
+    Instances of this class are returned by SibacProvider.get_search_table_diff().
+
+    Attributes:
+
+    columns_to_add:  A list of tuples (column_name, simple_field, as_value) for
+                     the columns required by the document type that are
+                     missing from the search table.
+    columns_to_drop: A list of names of the columns of the search table that
+                     aren't required anymore.
+
+    A column whose type has changed appears in both lists.
+    """
+    def __init__(self):
+        self.columns_to_add = []
+        self.columns_to_drop = []
+
+    @property
+    def is_empty(self):
+        return len(self.columns_to_add) == 0 and len(self.columns_to_drop) == 0
+
+def _exception_message(ex):
+    """Returns the message of an exception as an unicode string."""
+    if isinstance(ex, psycopg2.Error) and not ex.pgerror is None:
+        return unicode(ex.pgerror, "utf-8", "replace")
+    try:
+        return u"{0}: {1}".format(type(ex).__name__, unicode(ex))
+    except UnicodeDecodeError:
+        return u"{0}: {1}".format(type(ex).__name__, unicode(str(ex), "utf-8", "replace"))
+
+def _copy_value(value):
+    """
+    Returns the representation of a value in the text format of the
+    PostgreSQL COPY command, encoded as utf-8.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, list):
+        items = []
+        for v in value:
+            if v is None:
+                items.append("NULL")
+            else:
+                v = _copy_scalar(v)
+                items.append('"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"')
+        text = "{" + ",".join(items) + "}"
+    else:
+        text = _copy_scalar(value)
+    text = text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return text
+
+def _copy_scalar(value):
+    """Converts a single value to an utf-8 string."""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (date, dt_time, datetime)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        # str() keeps only 12 significant digits.
+        return repr(value)
+    return str(value)
 
 class SibacProvider:
     """
@@ -12,7 +292,13 @@ class SibacProvider:
         """Class constructor"""
         self.inspector = dt_inspector
         self.settings = settings
+        self.app_path = app_path
         self._set_connection_string()
+        self._set_connection_pool()
+        self._set_terms_cache()
+        self._full_text_ready = False
+        self._stream_itersize = self.settings.SIBACDATASOURCE.get("STREAM_ITERSIZE", 2000)
+        self._cursor_counter = itertools.count(1)
 
     def _set_connection_string(self):
         ds_info = self.settings.SIBACDATASOURCE
@@ -23,9 +309,65 @@ class SibacProvider:
                                                     ds_info["USER"],
                                                     ds_info["PASSWORD"])
 
+    def _set_connection_pool(self):
+        """
+        Creates the connection pool if POOL_MAX_SIZE is specified
+        in the SIBACDATASOURCE settings, otherwise each query will open
+        and close its own connection.
+        """
+        ds_info = self.settings.SIBACDATASOURCE
+        max_size = ds_info.get("POOL_MAX_SIZE", 0)
+        if max_size > 0:
+            self._pool = ConnectionPool(self._connection_string,
+                                        min_size=ds_info.get("POOL_MIN_SIZE", 0),
+                                        max_size=max_size,
+                                        timeout=ds_info.get("POOL_TIMEOUT", 30),
+                                        ping_after=ds_info.get("POOL_PING_AFTER", 30))
+        else:
+            self._pool = None
+
+    def _set_terms_cache(self):
+        """
+        Initializes the dictionary terms cache.
+
+        If TERMS_CACHE is True (default), the terms of a document type are
+        loaded the first time they are requested and kept in memory until a
+        method that changes the dictionaries is called. The changes are also
+        announced with a PostgreSQL NOTIFY, so that the other processes drop
+        their copies. TERMS_CACHE_NOTIFY defaults to the value of TERMS_CACHE:
+        set it to False only if a single process uses the database, otherwise
+        the other processes would keep serving stale terms.
+        """
+        ds_info = self.settings.SIBACDATASOURCE
+        self._terms_cache_enabled = ds_info.get("TERMS_CACHE", True)
+        self._terms_cache_notify = ds_info.get("TERMS_CACHE_NOTIFY", self._terms_cache_enabled)
+        # dt_sid -> {f_sid: OrderedDict of term -> url, sorted by term}
+        self._terms_cache = {}
+        # dt_sid -> (cached terms, result of get_dictionaries())
+        self._dictionaries_cache = {}
+        self._terms_lock = threading.RLock()
+        self._terms_listener = None
+        self._terms_listener_pid = None
+        self._inherited_listeners = []
+
     def _get_connection(self):
         """Returns a connection to the database"""
-        return psycopg2.connect(self._connection_string)
+        if self._pool is None:
+            return psycopg2.connect(self._connection_string)
+        else:
+            return self._pool.getconn()
+
+    def _release_connection(self, conn):
+        """
+        Gives back a connection obtained with _get_connection().
+
+        Pooled connections are returned to the pool, the other ones are
+        closed.
+        """
+        if self._pool is None:
+            conn.close()
+        else:
+            self._pool.putconn(conn)
 
     def _execute_ddl(self, sql_ddl, *params):
         """
@@ -46,7 +388,7 @@ class SibacProvider:
             cursor.close()
         finally:
             if not conn is None:
-                conn.close() 
+                self._release_connection(conn)
 
     def _execute_scalar(self, sql_str, *params):
         """
@@ -68,7 +410,7 @@ class SibacProvider:
             return value
         finally:
             if not conn is None:
-                conn.close()
+                self._release_connection(conn)
 
     def _execute_list(self, sql_str, *params):
         """
@@ -92,7 +434,7 @@ class SibacProvider:
             return value
         finally:
             if not conn is None:
-                conn.close()
+                self._release_connection(conn)
 
     def _execute_fetchall(self, sql_str, *params):
         """
@@ -113,7 +455,36 @@ class SibacProvider:
             return value
         finally:
             if not conn is None:
-                conn.close()
+                self._release_connection(conn)
+
+    def _execute_iter(self, sql_str, params=(), itersize=None):
+        """
+        Executes a query and yields the rows of the resultset one by one.
+
+        The rows are read through a named (server-side) cursor, fetching
+        itersize rows at a time (default: STREAM_ITERSIZE), so the whole
+        resultset is never kept in memory. The connection is held until
+        the iteration ends or the generator is closed.
+        """
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor_name = "sibac_stream_{0}".format(next(self._cursor_counter))
+            cursor = conn.cursor(name=cursor_name)
+            cursor.itersize = itersize or self._stream_itersize
+            if len(params) > 0:
+                cursor.execute(sql_str, params)
+            else:
+                cursor.execute(sql_str)
+            for row in cursor:
+                yield row
+            cursor.close()
+            conn.commit()
+        finally:
+            if not conn is None:
+                # If the iteration was interrupted, the pool rolls back the
+                # transaction and the server-side cursor is dropped with it.
+                self._release_connection(conn)
 
     def _execute_many(self, sql_str, touple_of_dicts):
         """Executes the psycopg2 executemany() method."""
@@ -126,7 +497,7 @@ class SibacProvider:
             cursor.close()
         finally:
             if not conn is None:
-                conn.close()
+                self._release_connection(conn)
 
 
     def _create_common_tables(self):
@@ -171,19 +542,88 @@ SELECT AddGeometryColumn('sibac_main', 'lines_data', {0}, 'MULTILINESTRING', 2);
 SELECT AddGeometryColumn('sibac_main', 'polys_data', {0}, 'MULTIPOLYGON', 2);"""
         ddl_string = ddl_string.format(self.settings.GEOREFERENCING["EPSGID"])
         if self.settings.SIBACDATASOURCE['FULLTEXT'] == True:
-            ddl_full_text_model = """
-CREATE INDEX who_index ON sibac_main USING gin(to_tsvector('{0}', full_who));
-CREATE INDEX what_index ON sibac_main USING gin(to_tsvector('{0}', full_what));
-CREATE INDEX where_index ON sibac_main USING gin(to_tsvector('{0}', full_where));
-CREATE INDEX from_where_index ON sibac_main USING gin(to_tsvector('{0}', full_from_where));
-CREATE INDEX when_index ON sibac_main USING gin(to_tsvector('{0}', full_when));
-CREATE INDEX doc_index ON sibac_main USING gin(to_tsvector('{0}', full_doc));"""
-            ddl_string += ddl_full_text_model.format(self.settings.SIBACDATASOURCE["FULLTEXT_LANG"])
+            ddl_string += self._get_full_text_ddl()
         self._execute_ddl(ddl_string)
 
+    # Suffixes of the full_* text columns of sibac_main. Each one has a
+    # tsv_* tsvector column, kept up to date by a trigger.
+    _full_text_facets = TextFacet.ALL
+
+    def _get_full_text_ddl(self, facets=None):
+        """
+        Returns the DDL that creates the tsvector columns of sibac_main,
+        their GIN indexes and the trigger that updates them. If facets is
+        not None, only the columns of those facets are created.
+        """
+        lang = self.settings.SIBACDATASOURCE["FULLTEXT_LANG"]
+        if facets is None:
+            facets = self._full_text_facets
+        ddl = ""
+        for f in facets:
+            ddl += "\nALTER TABLE sibac_main ADD COLUMN tsv_{0} tsvector;".format(f)
+            ddl += "\nCREATE INDEX tsv_{0}_index ON sibac_main USING gin(tsv_{0});".format(f)
+        assignments = "".join(["\n  NEW.tsv_{0} := to_tsvector('{1}', NEW.full_{0});".format(f, lang)
+                               for f in self._full_text_facets])
+        full_columns = ", ".join(["full_" + f for f in self._full_text_facets])
+        ddl += """
+DROP TRIGGER IF EXISTS sibac_main_tsv ON sibac_main;
+CREATE OR REPLACE FUNCTION sibac_main_tsv_update() RETURNS trigger AS $$
+BEGIN{0}
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER sibac_main_tsv BEFORE INSERT OR UPDATE OF {1} ON sibac_main
+  FOR EACH ROW EXECUTE PROCEDURE sibac_main_tsv_update();""".format(assignments, full_columns)
+        return ddl
+
+    def _get_missing_full_text_facets(self):
+        """
+        Returns the facets whose tsv_* column doesn't exist in sibac_main.
+        """
+        existing = self._get_table_columns("sibac_main") or {}
+        return [f for f in self._full_text_facets if not "tsv_" + f in existing]
+
+    def _check_full_text(self):
+        """
+        Raises ProviderError if the full text search can't be used, because
+        it's disabled in the settings or sibac_main lacks the tsv_* columns.
+        """
+        if self._full_text_ready:
+            return
+        if not self.settings.SIBACDATASOURCE['FULLTEXT'] == True:
+            msg = "La ricerca a testo libero non è abilitata: impostare FULLTEXT a True in SIBACDATASOURCE ed eseguire migrate_all_doc_types()."
+            raise ProviderError(msg)
+        if len(self._get_missing_full_text_facets()) > 0:
+            msg = "Il database non contiene le colonne della ricerca a testo libero: eseguire migrate_all_doc_types()."
+            raise ProviderError(msg)
+        self._full_text_ready = True
+
+    def migrate_full_text(self):
+        """
+        Adds to sibac_main the tsv_* columns, their indexes and their
+        trigger, if FULLTEXT is True and they don't exist yet (i.e. the
+        database was created with FULLTEXT set to False), then fills the
+        new columns from the full_* texts. Returns the list of the facets
+        added.
+
+        Usage:
+
+        provider.migrate_full_text()
+        ["who", "what", "where", "from_where", "when", "doc"]
+        """
+        if not self.settings.SIBACDATASOURCE['FULLTEXT'] == True:
+            return []
+        missing = self._get_missing_full_text_facets()
+        if len(missing) > 0:
+            lang = self.settings.SIBACDATASOURCE["FULLTEXT_LANG"]
+            assignments = ", ".join(["tsv_{0} = to_tsvector('{1}', full_{0})".format(f, lang) for f in missing])
+            self._execute_ddl(self._get_full_text_ddl(missing) + "\nUPDATE sibac_main SET " + assignments + ";")
+        return missing
+
     def _drop_common_tables(self):
         """Drops the tables shared by all documents."""
         drop_ddl = """DROP TABLE IF EXISTS sibac_main;
+DROP FUNCTION IF EXISTS sibac_main_tsv_update();
 DROP TABLE IF EXISTS packages"""
         self._execute_ddl(drop_ddl);
 
@@ -223,10 +663,53 @@ DROP TABLE IF EXISTS packages"""
                               FieldType.DECIMAL: 'numeric',
                               FieldType.DATE: 'date',
                               FieldType.TIME: 'time',
-                              FieldType.DATETIME: 'datetime',
+                              FieldType.DATETIME: 'timestamp',
                               FieldType.STRING: 'text',
                          }
 
+    # Names that format_type() returns for the types of _data_type_mappings
+    # written differently.
+    _catalog_type_names = {
+                              "time": "time without time zone",
+                              "timestamp": "timestamp without time zone",
+                          }
+
+    def _get_search_column_type(self, simple_field, as_value=False):
+        """
+        Returns the type of a column of the search table, as returned by
+        the format_type() function of PostgreSQL (i.e. "integer[]").
+        """
+        if as_value:
+            type_name = self._data_type_mappings[simple_field.field_type]
+        else:
+            type_name = "text"
+        type_name = self._catalog_type_names.get(type_name, type_name)
+        if simple_field.can_be_repeated:
+            type_name += "[]"
+        return type_name
+
+    def _get_table_columns(self, table_name):
+        """
+        Returns a dictionary that maps the name of each column of a table
+        to its type, or None if the table doesn't exist.
+        """
+        sql_str = """SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid
+WHERE c.relname = %s AND c.relkind = 'r' AND pg_table_is_visible(c.oid)
+  AND a.attnum > 0 AND NOT a.attisdropped"""
+        rows = self._execute_fetchall(sql_str, table_name.lower())
+        if len(rows) == 0:
+            return None
+        return dict(rows)
+
+    def _get_search_table_columns(self, dt_sid):
+        """
+        Returns a dictionary that maps the name of each column of the search
+        table of a document type to its type, or None if the table doesn't
+        exist.
+        """
+        return self._get_table_columns(dt_sid + "_search")
+
     def _create_search_table(self, document_type):
         """
         This method creates the search table for a specific document type.
@@ -249,19 +732,37 @@ DROP TABLE IF EXISTS packages"""
         ddl = ddl[:-2] + "\n);"
         self._execute_ddl(ddl);
 
-    def _create_multimedia_files_tables(self, document_type):
+    def _get_media_table_name(self, fsid):
+        """Returns the name of the table of a multimedia field."""
+        return fsid.replace(".", "_") + "__media"
+
+    def _get_media_table_names(self, dt_sid):
         """
-        This method creates a table for each simple field associated to
-        multimedia files.
+        Returns the names of the multimedia tables of a document type that
+        exist in the database, in lower case.
         """
-        for fsid in document_type.multimedia_fields:
-            ddl = """CREATE TABLE {0}__media (
+        sql_str = """SELECT c.relname FROM pg_class c
+WHERE c.relname LIKE %s AND c.relkind = 'r' AND pg_table_is_visible(c.oid)"""
+        pattern = dt_sid.lower().replace("_", "\\_") + "\\_%\\_\\_media"
+        return [r[0] for r in self._execute_fetchall(sql_str, pattern)]
+
+    def _create_multimedia_files_table(self, fsid):
+        """Creates the table of a simple field associated to multimedia files."""
+        ddl = """CREATE TABLE {0} (
   doc_id integer NOT NULL REFERENCES sibac_main (id) ON UPDATE CASCADE ON DELETE CASCADE,
   field_str text NOT NULL,
   file_name text NOT NULL,
   PRIMARY KEY (doc_id, field_str, file_name)
 )"""
-            self._execute_ddl(ddl.format(fsid).replace(".", "_"))
+        self._execute_ddl(ddl.format(self._get_media_table_name(fsid)))
+
+    def _create_multimedia_files_tables(self, document_type):
+        """
+        This method creates a table for each simple field associated to
+        multimedia files.
+        """
+        for fsid in document_type.multimedia_fields:
+            self._create_multimedia_files_table(fsid)
 
     def _remove_multimedia_files_tables(self, document_type):
         """
@@ -269,12 +770,437 @@ DROP TABLE IF EXISTS packages"""
         in the specified document type.
         """
         for fsid in document_type.multimedia_fields:
-            self._execute_ddl("DROP TABLE IF EXISTS {0}__media;".format(fsid).replace(".","_"))
+            self._execute_ddl("DROP TABLE IF EXISTS {0};".format(self._get_media_table_name(fsid)))
+
+    def _migrate_multimedia_files_tables(self, document_type):
+        """
+        Creates the tables of the new multimedia fields of a document type
+        and drops the tables of the fields that are no longer multimedia
+        or have been removed. Returns a tuple (created, dropped) with the
+        names of the tables.
+        """
+        existing = self._get_media_table_names(document_type.sid)
+        required = OrderedDict((self._get_media_table_name(fsid).lower(), fsid)
+                               for fsid in document_type.multimedia_fields)
+        dropped = [n for n in existing if not n in required]
+        created = [n for n in required if not n in existing]
+        for name in dropped:
+            self._execute_ddl("DROP TABLE IF EXISTS {0};".format(name))
+        for name in created:
+            self._create_multimedia_files_table(required[name])
+        return created, dropped
+
+    _TERMS_CHANNEL = "sibac_dictionaries"
+
+    def _get_cached_terms(self, dt_sid):
+        """
+        Returns the cached terms of a document type, as a dictionary
+        that maps each f_sid to an OrderedDict of term -> url.
+
+        The returned dictionaries are shared: don't modify them.
+        """
+        with self._terms_lock:
+            self._poll_terms_notifications()
+            terms = self._terms_cache.get(dt_sid)
+            if terms is None:
+                sql_str = "SELECT f_sid, term, term_url FROM sibac_dictionaries WHERE dt_sid=%s ORDER BY f_sid, term"
+                terms = {}
+                for f_sid, term, url in self._execute_fetchall(sql_str, dt_sid):
+                    if f_sid in terms:
+                        terms[f_sid][term] = url
+                    else:
+                        terms[f_sid] = OrderedDict([(term, url)])
+                self._terms_cache[dt_sid] = terms
+            return terms
+
+    def _get_cached_field_terms(self, field_path):
+        """Returns the OrderedDict of term -> url cached for a field."""
+        dt_sid = self.inspector.get_doc_type_sid(field_path)
+        norm_path = field_path.replace('.', '_')
+        return self._get_cached_terms(dt_sid).get(norm_path, OrderedDict())
+
+    def _terms_changed(self, dt_sid):
+        """
+        Drops the cached terms of a document type after a change and, if
+        TERMS_CACHE_NOTIFY is True, tells the other processes to do the same.
+        """
+        self.invalidate_terms_cache(dt_sid)
+        if self._terms_cache_enabled and self._terms_cache_notify:
+            self._execute_ddl("SELECT pg_notify(%s, %s)", self._TERMS_CHANNEL, dt_sid)
+
+    def _poll_terms_notifications(self):
+        """
+        Reads the notifications sent by the other processes and drops the
+        cached terms they refer to. The listening connection is opened on
+        the first call, and again in a forked process: the one inherited from
+        the parent is left open, since the parent is still using it.
+        """
+        if not self._terms_cache_notify:
+            return
+        if not self._terms_listener is None and not self._terms_listener_pid == os.getpid():
+            self._inherited_listeners.append(self._terms_listener)
+            self._terms_listener = None
+        try:
+            if self._terms_listener is None:
+                conn = psycopg2.connect(self._connection_string)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute("LISTEN " + self._TERMS_CHANNEL)
+                cursor.close()
+                self._terms_listener = conn
+                self._terms_listener_pid = os.getpid()
+                # Changes made before listening are unknown.
+                self._terms_cache.clear()
+            self._terms_listener.poll()
+            while self._terms_listener.notifies:
+                notify = self._terms_listener.notifies.pop()
+                self._terms_cache.pop(notify.payload, None)
+        except psycopg2.Error:
+            # Without a working listener the cache can't be trusted.
+            if not self._terms_listener is None:
+                try:
+                    self._terms_listener.close()
+                except psycopg2.Error:
+                    pass
+            self._terms_listener = None
+            self._terms_cache.clear()
+
+    # Columns of sibac_main used by the metafields that can be applied
+    # to the document type in a search expression.
+    _metafield_columns = {
+                             "_id": "m.id",
+                             "_author_id": "m.author_id",
+                             "_last_editor_id": "m.last_editor_id",
+                             "_package_name": "m.package_name",
+                             "_creation_date": "m.creation_date",
+                             "_last_edit_date": "m.edit_date",
+                         }
+
+    _comparison_operators = {
+                                ComparisonOperator.EQUAL: "=",
+                                ComparisonOperator.LESSER: "<",
+                                ComparisonOperator.GREATER: ">",
+                                ComparisonOperator.LESSER_OR_EQUAL: "<=",
+                                ComparisonOperator.GREATER_OR_EQUAL: ">=",
+                            }
+
+    # Used with "value op ANY(array)", where the operands are swapped.
+    _swapped_operators = {
+                             ComparisonOperator.EQUAL: "=",
+                             ComparisonOperator.LESSER: ">",
+                             ComparisonOperator.GREATER: "<",
+                             ComparisonOperator.LESSER_OR_EQUAL: ">=",
+                             ComparisonOperator.GREATER_OR_EQUAL: "<=",
+                         }
+
+    _boolean_operators = {
+                             BooleanOperator.AND: "AND",
+                             BooleanOperator.OR: "OR",
+                             BooleanOperator.AND_NOT: "AND NOT",
+                             BooleanOperator.OR_NOT: "OR NOT",
+                         }
+
+    _documents_columns = "m.id, m.package_name, m.author_id, m.creation_date, m.edit_date, m.last_editor_id, m.entire_document"
+
+    def _get_search_expression(self, search_expr):
+        """
+        Returns a validated SearchExpression instance. search_expr can be
+        an instance of SearchExpression or a string.
+
+        Raises SearchExpressionError if the expression is not valid.
+        """
+        if isinstance(search_expr, basestring):
+            # Strings go through the expression cache.
+            val_res, search_expr = SearchExpression.validate_expression_string(search_expr, self, True)
+            if not val_res.is_valid:
+                raise SearchExpressionError(" ".join(val_res.errors))
+            return search_expr
+        if not search_expr.from_doc in self.inspector.doc_types:
+            raise SearchExpressionError("Il tipo di documento specificato nella clausola FROM non esiste.")
+        doc_type = self.inspector.doc_types[search_expr.from_doc]
+        val_res = search_expr.validate(doc_type, allow_for_storage_only=True)
+        if not val_res.is_valid:
+            raise SearchExpressionError(" ".join(val_res.errors))
+        return search_expr
+
+    def _compile_search_expression(self, search_expr, select_str=None):
+        """
+        Compiles a validated SearchExpression into a parameterized query over
+        sibac_main joined to the search table of the document type.
+
+        Returns a tuple (sql_str, params). select_str is the list of
+        columns to select (default: the columns used to build Document
+        instances).
+        """
+        doc_type = self.inspector.doc_types[search_expr.from_doc]
+        if select_str is None:
+            select_str = self._documents_columns
+        params = [doc_type.sid]
+        sql_str = "SELECT {0} FROM sibac_main m JOIN {1}_search s ON s.id = m.id WHERE m.dt_sid = %s".format(select_str, doc_type.sid)
+        if len(search_expr.where.conditions) > 0:
+            sql_str += " AND " + self._compile_conditions(doc_type, search_expr.where.conditions, params)
+        if len(search_expr.order_by) > 0:
+            order_list = []
+            for o in search_expr.order_by:
+                column, is_array, is_text = self._get_search_column(doc_type, o.field)
+                order_list.append(column + (" ASC" if o.ascendant else " DESC"))
+            sql_str += " ORDER BY " + ", ".join(order_list)
+        return sql_str, params
+
+    def _compile_conditions(self, doc_type, conditions, params):
+        """
+        Compiles a list of search conditions and parentheses.
+
+        Conditions are merged from left to right, as done by
+        Document.validate_against_expr(). A single condition that compares
+        a missing value is NULL in SQL: it's turned into false, as done by
+        the predicates of SearchExpression.compile(), so that NOT, AND NOT
+        and OR NOT don't drop the rows where it's NULL.
+        """
+        sql_str = None
+        for c in conditions:
+            if hasattr(c, "conditions"):
+                cond_str = "(" + self._compile_conditions(doc_type, c.conditions, params) + ")"
+            else:
+                cond_str = "coalesce((" + self._compile_condition(doc_type, c, params) + "), false)"
+            if sql_str is None:
+                sql_str = "NOT " + cond_str if c.bool_op == BooleanOperator.NOT else cond_str
+            else:
+                sql_str = "({0} {1} {2})".format(sql_str, self._boolean_operators[c.bool_op], cond_str)
+        return sql_str
+
+    def _compile_condition(self, doc_type, condition, params):
+        """Compiles a single search condition."""
+        column, is_array, is_text = self._get_search_column(doc_type, condition.field)
+        comp_val = self._get_search_value(doc_type, condition.field, condition.compare_to)
+        op = condition.comp_op
+        if op == ComparisonOperator.LIKE:
+            if not isinstance(comp_val, basestring):
+                raise SearchExpressionError("L'operatore LIKE non può essere usato sull'elemento {0}.".format(condition.field))
+            escaped = comp_val.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append("%" + escaped + "%")
+            if is_array:
+                return "EXISTS (SELECT 1 FROM unnest({0}) AS v WHERE v ILIKE %s)".format(column)
+            else:
+                return "{0} ILIKE %s".format(column)
+        params.append(comp_val)
+        if op == ComparisonOperator.EQUAL and is_text:
+            # String comparison is case-insensitive.
+            if is_array:
+                return "EXISTS (SELECT 1 FROM unnest({0}) AS v WHERE upper(v) = upper(%s))".format(column)
+            else:
+                return "upper({0}) = upper(%s)".format(column)
+        if is_array:
+            return "%s {0} ANY({1})".format(self._swapped_operators[op], column)
+        else:
+            return "{0} {1} %s".format(column, self._comparison_operators[op])
+
+    def _split_search_field(self, doc_type, field):
+        """
+        Returns a tuple (complete_path, metafield_name) for a field of a
+        search expression, i.e. ("SI.CD.NCT.NCTN", "_as_val").
+        """
+        if "._" in field:
+            underscore_index = field.index("._")
+            metafield_name = field[underscore_index + 1:]
+        else:
+            metafield_name = None
+        complete_path = doc_type.get_complete_paths(field, error_if_ambiguous=True)[0]
+        return complete_path, metafield_name
+
+    def _get_search_column(self, doc_type, field):
+        """
+        Returns a tuple (column_expression, is_array, is_text) for a field
+        of a search expression.
+
+        The search table has columns only for the simple fields, so the
+        _count of a paragraph or of a structured field can't be compiled:
+        SearchExpressionError is raised, even though SearchExpression
+        accepts it when the documents are filtered in memory.
+        """
+        complete_path, metafield_name = self._split_search_field(doc_type, field)
+        if complete_path == doc_type.sid:
+            if not metafield_name in self._metafield_columns:
+                raise SearchExpressionError("Il metacampo {0} non è supportato da questo provider.".format(metafield_name))
+            return self._metafield_columns[metafield_name], False, metafield_name == "_package_name"
+        if not complete_path in doc_type.simple_fields:
+            msg = "Il metacampo {0} non può essere applicato a {1}: questo provider non supporta le ricerche su paragrafi e campi strutturati."
+            raise SearchExpressionError(msg.format(metafield_name, complete_path))
+        simple_field = doc_type.simple_fields[complete_path]
+        if metafield_name is None:
+            column = "s." + self._get_column_name(simple_field)
+            return column, simple_field.can_be_repeated, True
+        elif metafield_name == "_as_val":
+            is_text = simple_field.field_type == FieldType.STRING
+            column = "s." + self._get_column_name(simple_field, not is_text)
+            return column, simple_field.can_be_repeated, is_text
+        elif metafield_name == "_count":
+            column = "s." + self._get_column_name(simple_field)
+            if simple_field.can_be_repeated:
+                return "coalesce(array_length({0}, 1), 0)".format(column), False, False
+            else:
+                return "(CASE WHEN {0} IS NULL THEN 0 ELSE 1 END)".format(column), False, False
+        else:
+            raise SearchExpressionError("Il metacampo {0} non è supportato da questo provider.".format(metafield_name))
+
+    def _get_search_value(self, doc_type, field, compare_to):
+        """Converts the compare_to value of a condition for the query."""
+        complete_path, metafield_name = self._split_search_field(doc_type, field)
+        if metafield_name in ("_id", "_author_id", "_last_editor_id", "_count"):
+            try:
+                return int(compare_to)
+            except (TypeError, ValueError):
+                raise SearchExpressionError("Il metacampo {0} richiede un numero intero come termine di paragone.".format(metafield_name))
+        elif metafield_name == "_as_val":
+            return doc_type.simple_fields[complete_path].converter(compare_to)
+        else:
+            return compare_to
+
+    def _document_from_row(self, dt_sid, row):
+        """Creates a Document from a row selected with _documents_columns."""
+        return Document(dt_sid=dt_sid, doc_id=row[0], package_name=row[1],
+                        author_id=row[2], creation_date=row[3], last_edit_date=row[4],
+                        last_editor_id=row[5], json_str=row[6], provider=self)
+
+    _main_copy_columns = ("id", "package_name", "dt_sid", "full_who", "full_what",
+                          "full_where", "full_from_where", "full_when", "full_doc",
+                          "entire_document", "creation_date", "edit_date",
+                          "author_id", "last_editor_id")
+
+    def _get_search_copy_columns(self, doc_type):
+        """
+        Returns a list of tuples (column_name, simple_field, as_value) for
+        the columns of the search table of a document type.
+        """
+        columns = []
+        for fsid in doc_type.simple_fields:
+            sf = doc_type.simple_fields[fsid]
+            columns.append((self._get_column_name(sf), sf, False))
+            if not sf.field_type == FieldType.STRING:
+                columns.append((self._get_column_name(sf, True), sf, True))
+        return columns
+
+    def _get_search_values(self, document, search_columns):
+        """
+        Returns the values of a document for the columns returned by
+        _get_search_copy_columns(): lists for repeatable fields, single
+        values for the other ones.
+        """
+        # The contents are indexed once for all the columns.
+        index = document._build_contents_index()
+        search_values = []
+        for column_name, sf, as_value in search_columns:
+            values = index.get(sf.complete_path, [])
+            if as_value:
+                values = [sf.converter(v) for v in values]
+            if sf.can_be_repeated:
+                search_values.append(values if len(values) > 0 else None)
+            else:
+                search_values.append(values[0] if len(values) > 0 else None)
+        return search_values
+
+    def _get_copy_lines(self, doc_id, document, search_columns):
+        """
+        Returns the COPY lines of a document for sibac_main and for the
+        search table of its document type.
+        """
+        full_texts = document.get_full_texts()
+        creation_date = document.creation_date or datetime.now()
+        main_values = [doc_id, document.package_name, document.dt_sid,
+                       full_texts["full_who"], full_texts["full_what"],
+                       full_texts["full_where"], full_texts["full_from_where"],
+                       full_texts["full_when"], full_texts["full_doc"],
+                       document.json_encode(), creation_date,
+                       document.last_edit_date or creation_date,
+                       document.author_id, document.last_editor_id]
+        search_values = [doc_id] + self._get_search_values(document, search_columns)
+        main_line = "\t".join([_copy_value(v) for v in main_values]) + "\n"
+        search_line = "\t".join([_copy_value(v) for v in search_values]) + "\n"
+        return main_line, search_line
+
+    def _copy_lines(self, cursor, dt_sid, search_columns, lines):
+        """Sends a list of (main_line, search_line) with COPY FROM STDIN."""
+        main_copy = "COPY sibac_main ({0}) FROM STDIN".format(", ".join(self._main_copy_columns))
+        cursor.copy_expert(main_copy, StringIO("".join([l[0] for l in lines])))
+        search_copy = "COPY {0}_search (id, {1}) FROM STDIN".format(dt_sid, ", ".join([c[0] for c in search_columns]))
+        cursor.copy_expert(search_copy, StringIO("".join([l[1] for l in lines])))
+
+    def _ingest_batch(self, conn, dt_sid, search_columns, batch, result):
+        """
+        Inserts a batch of (index, document) tuples in a single transaction.
+
+        If COPY fails for the whole batch, the documents are inserted one
+        by one, each in its own savepoint, so that only the failing ones
+        are reported as errors. Documents whose COPY lines can't be built
+        are reported as errors too.
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT nextval('sibac_main_id_seq') FROM generate_series(1, %s)", (len(batch),))
+            all_ids = [r[0] for r in cursor.fetchall()]
+            valid_batch = []
+            ids = []
+            lines = []
+            for (index, document), doc_id in zip(batch, all_ids):
+                try:
+                    doc_lines = self._get_copy_lines(doc_id, document, search_columns)
+                except Exception as ex:
+                    result.errors.append((index, [_exception_message(ex)]))
+                    continue
+                valid_batch.append((index, document))
+                ids.append(doc_id)
+                lines.append(doc_lines)
+            batch = valid_batch
+            if len(batch) == 0:
+                conn.commit()
+                return
+            try:
+                self._copy_lines(cursor, dt_sid, search_columns, lines)
+                conn.commit()
+                inserted = zip(batch, ids)
+            except psycopg2.DatabaseError:
+                conn.rollback()
+                inserted = []
+                for (index, document), doc_id, doc_lines in zip(batch, ids, lines):
+                    cursor.execute("SAVEPOINT sibac_ingest")
+                    try:
+                        self._copy_lines(cursor, dt_sid, search_columns, [doc_lines])
+                        cursor.execute("RELEASE SAVEPOINT sibac_ingest")
+                        inserted.append(((index, document), doc_id))
+                    except psycopg2.DatabaseError as ex:
+                        cursor.execute("ROLLBACK TO SAVEPOINT sibac_ingest")
+                        result.errors.append((index, [_exception_message(ex)]))
+                conn.commit()
+            for (index, document), doc_id in inserted:
+                document.doc_id = doc_id
+                result.doc_ids.append(doc_id)
+        finally:
+            cursor.close()
 
     # Public interface methods.
     # If you wish to create another provider, make sure that your class
     # will expose the methods declared below.
     
+    def get_pool_stats(self):
+        """
+        Returns a dictionary describing the connection pool usage, or None
+        if connection pooling is disabled.
+
+        Usage:
+
+        provider.get_pool_stats()
+        {"min_size": 1, "max_size": 10, "in_use": 2, "idle": 3, "created": 5,
+         "reused": 120, "discarded": 0, "checkouts": 125, "waits": 0}
+        """
+        if self._pool is None:
+            return None
+        return self._pool.get_stats()
+
+    def close(self):
+        """Closes all the idle connections held by the provider."""
+        if not self._pool is None:
+            self._pool.closeall()
+
     def initialize_storage(self):
         """This method creates the database tables."""
         self.initialize_settings()
@@ -308,13 +1234,15 @@ DROP TABLE IF EXISTS packages"""
   term text NOT NULL,
   term_url text,
   PRIMARY KEY (dt_sid, f_sid, term)
-  );"""
+  );
+CREATE INDEX sibac_dictionaries_prefix ON sibac_dictionaries (dt_sid, f_sid, upper(term) text_pattern_ops);"""
         self._execute_ddl(ddl_string)
 
     def clear_dictionaries(self):
         """Drop the dictionary table if it not exists."""
         ddl_string = "DROP TABLE IF EXISTS sibac_dictionaries;"
         self._execute_ddl(ddl_string)
+        self.invalidate_terms_cache()
 
     def initialize_doc_type(self, dt_sid):
         """Creates the database entities concerning a specific document type."""
@@ -340,17 +1268,143 @@ DROP TABLE IF EXISTS packages"""
         for sid in self.inspector.doc_types:
             self.remove_doc_type(sid)
 
+    def get_search_table_diff(self, dt_sid):
+        """
+        Compares the search table of a document type with the columns
+        required by the current definition of the document type, and
+        returns a SearchTableDiff. Changes of the uniqueness groups are not
+        detected.
+
+        Raises ProviderError if the search table doesn't exist.
+
+        Usage:
+
+        diff = provider.get_search_table_diff("SI")
+        print [c[0] for c in diff.columns_to_add], diff.columns_to_drop
+        """
+        existing = self._get_search_table_columns(dt_sid)
+        if existing is None:
+            msg = "La tabella di ricerca del tipo {0} non esiste: usare initialize_doc_type().".format(dt_sid)
+            raise ProviderError(msg)
+        doc_type = self.inspector.doc_types[dt_sid]
+        diff = SearchTableDiff()
+        required = set(["id"])
+        for column_name, sf, as_value in self._get_search_copy_columns(doc_type):
+            # Unquoted identifiers are stored in lower case.
+            name = column_name.lower()
+            required.add(name)
+            if not existing.get(name) == self._get_search_column_type(sf, as_value):
+                if name in existing:
+                    diff.columns_to_drop.append(name)
+                diff.columns_to_add.append((column_name, sf, as_value))
+        diff.columns_to_drop.extend(sorted([n for n in existing if not n in required]))
+        return diff
+
+    def migrate_doc_type(self, dt_sid, batch_size=1000, progress=None):
+        """
+        Updates the search table of a document type after a change of its
+        definition, without rebuilding it: the columns reported by
+        get_search_table_diff() are dropped and added with ALTER TABLE,
+        then only the added columns are filled, reading the documents from
+        sibac_main.entire_document, batch_size documents per transaction.
+        Returns the number of documents processed.
+
+        The <field>__media tables are created for the new multimedia fields
+        and dropped, with their rows, for the fields that are no longer
+        multimedia or no longer exist.
+
+        The progress is saved in the settings table with every batch, so
+        if the migration is interrupted, calling this method again resumes
+        it from the last completed batch. progress, if not None, is called
+        after every batch with two arguments: the number of documents
+        processed and the total number of documents.
+
+        If the search table doesn't exist yet (i.e. the document type has
+        just been added), the storage entities of the document type are
+        created with initialize_doc_type() and 0 is returned.
+
+        Usage:
+
+        def print_progress(done, total):
+            print "{0}/{1}".format(done, total)
+
+        provider.migrate_doc_type("SI", progress=print_progress)
+        """
+        doc_type = self.inspector.doc_types[dt_sid]
+        if self._get_search_table_columns(dt_sid) is None:
+            self.initialize_doc_type(dt_sid)
+            return 0
+        self._migrate_multimedia_files_tables(doc_type)
+        state_key = "_SearchTableMigration_" + dt_sid
+        state_json = self.get_setting(state_key)
+        if state_json is None:
+            state = {"columns": [], "last_id": 0, "done": 0}
+        else:
+            state = json.loads(state_json)
+        diff = self.get_search_table_diff(dt_sid)
+        if not diff.is_empty:
+            added = [c[0].lower() for c in diff.columns_to_add]
+            if len(added) > 0:
+                # The columns of an interrupted migration are filled again
+                # from the start, together with the new ones.
+                pending = [n for n in state["columns"] if not n in diff.columns_to_drop]
+                state = {"columns": pending + added, "last_id": 0, "done": 0}
+            else:
+                state["columns"] = [n for n in state["columns"] if not n in diff.columns_to_drop]
+            alters = ["DROP COLUMN " + n for n in diff.columns_to_drop]
+            alters += ["ADD COLUMN " + self._get_db_field_declaration(c[1], c[2]) for c in diff.columns_to_add]
+            # The table and the saved state are changed in the same transaction.
+            conn = None
+            try:
+                conn = self._get_connection()
+                cursor = conn.cursor()
+                cursor.execute("ALTER TABLE {0}_search {1}".format(dt_sid, ", ".join(alters)))
+                cursor.execute(self._change_setting_sql, {"key": state_key, "val": json.dumps(state)})
+                conn.commit()
+                cursor.close()
+            finally:
+                if not conn is None:
+                    self._release_connection(conn)
+        if len(state["columns"]) > 0:
+            columns = [c for c in self._get_search_copy_columns(doc_type) if c[0].lower() in state["columns"]]
+            self._backfill_search_columns(dt_sid, columns, state, state_key, batch_size, progress)
+        self.delete_setting(state_key)
+        return state["done"]
+
+    def migrate_all_doc_types(self, batch_size=1000, progress=None):
+        """
+        Calls migrate_full_text() and then migrate_doc_type() for all
+        document types. progress, if not None, is called with three
+        arguments: the sid of the document type, the number of documents
+        processed and the total.
+
+        Usage:
+
+        def print_progress(dt_sid, done, total):
+            print "{0}: {1}/{2}".format(dt_sid, done, total)
+
+        provider.migrate_all_doc_types(progress=print_progress)
+        """
+        self.migrate_full_text()
+        for sid in self.inspector.doc_types:
+            if progress is None:
+                self.migrate_doc_type(sid, batch_size)
+            else:
+                self.migrate_doc_type(sid, batch_size,
+                                      lambda done, total, sid=sid: progress(sid, done, total))
+
+    _change_setting_sql = """UPDATE sibac_settings SET sett_value=%(val)s WHERE sett_key=%(key)s;
+INSERT INTO sibac_settings (sett_key, sett_value)
+SELECT %(key)s, %(val)s
+WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(key)s);"""
+
     def change_setting(self, key, value):
         """Adds or updates a setting.
 
         Both key and value must be strings. It's also possibile to set a value
         to None."""
-        sql_str = """UPDATE sibac_settings SET sett_value=%(val)s WHERE sett_key=%(key)s;
-INSERT INTO sibac_settings (sett_key, sett_value)
-SELECT %(key)s, %(val)s
-WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(key)s);"""
         param_dict = {"key": key, "val": value}
-        self._execute_ddl(sql_str, param_dict)
+        self._execute_ddl(self._change_setting_sql, param_dict)
 
     def delete_setting(self, key, delete_if_none=False):
         """Delete a setting from the table.
@@ -409,6 +1463,7 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         norm_path = field_path.replace('.', '_')
         sql_str = "INSERT INTO sibac_dictionaries (dt_sid, f_sid, term, term_url) VALUES (%s, %s, %s, %s)"
         self._execute_ddl(sql_str, dt_sid, norm_path, term, url)
+        self._terms_changed(dt_sid)
 
     def remove_term(self, field_path, term):
         """
@@ -421,6 +1476,7 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         norm_path = field_path.replace('.', '_')
         sql_str = "DELETE FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s AND term=%s"
         self._execute_ddl(sql_str, dt_sid, norm_path, term)
+        self._terms_changed(dt_sid)
 
     def remove_all_terms(self, field_path):
         """
@@ -430,6 +1486,7 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         norm_path = field_path.replace('.', '_')
         sql_str = "DELETE FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s"
         self._execute_ddl(sql_str, dt_sid, norm_path)
+        self._terms_changed(dt_sid)
 
     def remove_all_terms_for_doc_type(self, dt_sid):
         """
@@ -437,21 +1494,28 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         """
         sql_str = "DELETE FROM sibac_dictionaries WHERE dt_sid=%s"
         self._execute_ddl(sql_str, dt_sid)
+        self._terms_changed(dt_sid)
 
     def check_term(self, field_path, term):
         """
         This method returns a boolean value that specifies if a term exists in the
         dictionaries tables.
         """
+        if self._terms_cache_enabled:
+            return term in self._get_cached_field_terms(field_path)
         dt_sid = self.inspector.get_doc_type_sid(field_path)
         norm_path = field_path.replace('.', '_')
         sql_str = "SELECT EXISTS (SELECT true FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s AND term=%s);"
         return self._execute_scalar(sql_str, dt_sid, norm_path, term)
 
-    def get_terms(self, field_path, starts_with=None):
+    def get_terms(self, field_path, starts_with=None, limit=None):
         """
         This method returns a list terms.
 
+        If starts_with is specified, only the terms starting with it are
+        returned (case-insensitive). limit is the max number of terms to
+        return.
+
         Usage:
 
         provider.get_terms("SI.CD.TSK")
@@ -462,39 +1526,47 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         provider.get_terms("SI.CD.ECP", "S")
         ["S01", "S02", ...]
         """
-        dt_sid = self.inspector.get_doc_type_sid(field_path)
-        norm_path = field_path.replace('.', '_')
-        if starts_with is None:
-            sql_str = "SELECT term FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s"
-            params = (dt_sid, norm_path)
-        else:
-            sql_str = "SELECT term FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s AND term ILIKE %s"
-            params = (dt_sid, norm_path, starts_with.replace("%", "\%").replace("_", "\_") + "%")
-            print params
-        return self._execute_list(sql_str, *params)
+        return [t[0] for t in self.get_terms_with_urls(field_path, starts_with, limit)]
 
-    def get_terms_with_urls(self, field_path, starts_with=None):
+    def get_terms_with_urls(self, field_path, starts_with=None, limit=None):
         """
-        This method returns a list of terms.
+        This method returns a list of tuples (term, url).
+
+        If starts_with is specified, only the terms starting with it are
+        returned (case-insensitive). limit is the max number of terms to
+        return.
 
         Usage:
 
-        provider.get_terms("SI.CD.TSK")
-        ["SI"]
+        provider.get_terms_with_urls("SI.CD.TSK")
+        [("SI", "http://www.x.yy")]
         
         or
 
-        provider.get_terms("SI.CD.ECP", "S")
-        ["S01", "S02", ...]
+        provider.get_terms_with_urls("SI.CD.ECP", "S", 10)
+        [("S01", None), ("S02", None), ...]
         """
         dt_sid = self.inspector.get_doc_type_sid(field_path)
+        if self._terms_cache_enabled:
+            terms = self.get_dictionaries(dt_sid).get(field_path)
+            if terms is None:
+                return []
+            elif starts_with is None:
+                return terms.items()[:limit]
+            else:
+                return terms.starts_with(starts_with, limit)
         norm_path = field_path.replace('.', '_')
         if starts_with is None:
-            sql_str = "SELECT term, term_url FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s"
+            sql_str = "SELECT term, term_url FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s ORDER BY term"
             params = (dt_sid, norm_path)
         else:
-            sql_str = "SELECT term, term_url FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s AND term ILIKE %s"
-            params = (dt_sid, norm_path, starts_with.replace("%", "\\%").replace("_", "\_") + "%")
+            # Served by the sibac_dictionaries_prefix index.
+            sql_str = "SELECT term, term_url FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s AND upper(term) LIKE upper(%s) ORDER BY term"
+            escaped = starts_with.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params = (dt_sid, norm_path, escaped + "%")
+        if not limit is None:
+            sql_str += " LIMIT %s"
+            params += (limit,)
         return self._execute_fetchall(sql_str, *params)
 
     def get_all_terms(self, dt_sid):
@@ -507,6 +1579,9 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         provider.get_all_terms("SI")
         {"SI.CD.TSK": ["SI"], "SI.CD.LIR": ["I", "P", "C"], ...}
         """
+        if self._terms_cache_enabled:
+            cached = self._get_cached_terms(dt_sid)
+            return dict((k, v.keys()) for k, v in cached.iteritems())
         sql_str = "SELECT f_sid, term FROM sibac_dictionaries WHERE dt_sid=%s ORDER BY f_sid, term"
         dataset = self._execute_fetchall(sql_str, dt_sid)
         ret_dict = {}
@@ -529,6 +1604,9 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         provider.get_all_terms("SI")
         {"SI.CD.TSK": [("SI", "http://www.x.yy"), ...], "SI.CD.LIR": [("I", "http://..."), ...]
         """
+        if self._terms_cache_enabled:
+            cached = self._get_cached_terms(dt_sid)
+            return dict((k, v.items()) for k, v in cached.iteritems())
         sql_str = "SELECT f_sid, term, term_url FROM sibac_dictionaries WHERE dt_sid=%s ORDER BY f_sid, term"
         dataset = self._execute_fetchall(sql_str, dt_sid)
         ret_dict = {}
@@ -541,6 +1619,43 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
                 ret_dict[k] = [t]
         return ret_dict
 
+    def get_dictionaries(self, dt_sid):
+        """
+        Returns a dictionary that maps the complete path of every field of
+        the document type that has terms to a TermsDictionary instance.
+
+        This is the structure used by sibaclib.documents.Document.validate()
+        to check closed dictionaries. When the terms cache is enabled, the
+        same instances are returned until the terms change: don't modify them.
+
+        Usage:
+
+        d = provider.get_dictionaries("SI")
+        "AN" in d["SI.LC.PVC.PVCP"]
+        True
+        """
+        if not self._terms_cache_enabled:
+            return self._build_dictionaries(dt_sid, self.get_all_terms(dt_sid))
+        with self._terms_lock:
+            terms = self._get_cached_terms(dt_sid)
+            cached = self._dictionaries_cache.get(dt_sid)
+            if cached is None or not cached[0] is terms:
+                cached = (terms, self._build_dictionaries(dt_sid, terms))
+                self._dictionaries_cache[dt_sid] = cached
+            return cached[1]
+
+    def _build_dictionaries(self, dt_sid, terms):
+        """
+        Converts the terms grouped by f_sid into the dictionary returned
+        by get_dictionaries().
+        """
+        paths = dict((k.replace('.', '_'), k) for k in self.inspector.doc_types[dt_sid].simple_fields)
+        result = {}
+        for f_sid in terms:
+            if f_sid in paths:
+                result[paths[f_sid]] = TermsDictionary(terms[f_sid])
+        return result
+
     def get_term_url(self, field_path):
         """
         Gets an url corresponding to the specific term.
@@ -552,3 +1667,300 @@ WHERE NOT EXISTS (SELECT 1 FROM sibac_settings WHERE sett_key=%(k)s);"""
         norm_path = field_path.replace('.', '_')
         sql_str = "SELECT term_url FROM sibac_dictionaries WHERE dt_sid=%s AND f_sid=%s"
         self._execute_scalar(sql_str, dt_sid, norm_path)
+
+    def invalidate_terms_cache(self, dt_sid=None):
+        """
+        Drops the cached dictionary terms of the specified document type, or
+        of all document types if dt_sid is None.
+
+        Call this method after changing the sibac_dictionaries table without
+        using the methods of this class.
+        """
+        with self._terms_lock:
+            if dt_sid is None:
+                self._terms_cache.clear()
+            else:
+                self._terms_cache.pop(dt_sid, None)
+
+    def search(self, search_expr, limit=None, offset=0):
+        """
+        Returns the list of the documents matching a search expression.
+
+        search_expr can be a SearchExpression instance or a string. The
+        expression is compiled into a single SQL query, so the documents
+        are filtered by the database.
+
+        Raises SearchExpressionError if the expression is not valid or uses
+        metafields not supported by this provider, such as _count applied
+        to a paragraph or to a structured field.
+
+        Usage:
+
+        provider.search('SELECT * FROM SI WHERE PVCP = "AN" ORDER_BY NCTN', limit=20)
+        [<Document>, <Document>, ...]
+        """
+        search_expr = self._get_search_expression(search_expr)
+        sql_str, params = self._compile_search_expression(search_expr)
+        if not limit is None:
+            sql_str += " LIMIT %s"
+            params.append(limit)
+        if offset:
+            sql_str += " OFFSET %s"
+            params.append(offset)
+        rows = self._execute_fetchall(sql_str, *params)
+        return [self._document_from_row(search_expr.from_doc, r) for r in rows]
+
+    def count(self, search_expr):
+        """Returns the number of documents matching a search expression."""
+        search_expr = self._get_search_expression(search_expr)
+        search_expr = search_expr.copy()
+        search_expr.order_by = []
+        sql_str, params = self._compile_search_expression(search_expr, "count(*)")
+        return self._execute_scalar(sql_str, *params)
+
+    def iter_search(self, search_expr, itersize=None):
+        """
+        Same as search(), but yields the documents one by one, reading them
+        from a server-side cursor. Use it to export or process large
+        resultsets in constant memory.
+
+        itersize is the number of rows fetched by each round trip to the
+        server (default: the STREAM_ITERSIZE setting).
+
+        Usage:
+
+        for doc in provider.iter_search('SELECT * FROM SI WHERE PVCP = "AN"'):
+            print doc.doc_id
+        """
+        search_expr = self._get_search_expression(search_expr)
+        sql_str, params = self._compile_search_expression(search_expr)
+        for row in self._execute_iter(sql_str, params, itersize):
+            yield self._document_from_row(search_expr.from_doc, row)
+
+    def iter_documents(self, dt_sid, itersize=None):
+        """
+        Yields all the documents of a document type, ordered by id, reading
+        them from a server-side cursor.
+
+        Usage:
+
+        for doc in provider.iter_documents("SI"):
+            reindex(doc)
+        """
+        sql_str = "SELECT {0} FROM sibac_main m WHERE m.dt_sid = %s ORDER BY m.id".format(self._documents_columns)
+        for row in self._execute_iter(sql_str, (dt_sid,), itersize):
+            yield self._document_from_row(dt_sid, row)
+
+    def bulk_ingest(self, dt_sid, documents, batch_size=1000, validate=True):
+        """
+        Inserts many documents of the same document type with COPY FROM
+        STDIN, batch_size documents per transaction.
+
+        documents can be any iterable, also a generator: only one batch is
+        kept in memory. If validate is True, documents that can't be saved
+        are skipped. The full_* texts and the search table columns are
+        derived from each document. Errors never stop the load: they are
+        collected in the returned BulkIngestResult. The doc_id attribute of
+        the inserted documents is set.
+
+        Usage:
+
+        result = provider.bulk_ingest("SI", read_documents())
+        print result.inserted_count, len(result.errors)
+        """
+        doc_type = self.inspector.doc_types[dt_sid]
+        search_columns = self._get_search_copy_columns(doc_type)
+        result = BulkIngestResult()
+        conn = None
+        try:
+            conn = self._get_connection()
+            batch = []
+            for index, document in enumerate(documents):
+                if document.provider is None:
+                    document.provider = self
+                messages = None
+                if not document.dt_sid == dt_sid:
+                    messages = ["Il documento appartiene al tipo {0} e non a {1}.".format(document.dt_sid, dt_sid)]
+                elif validate:
+                    try:
+                        val_res = document.validate()
+                        if not val_res.can_be_saved:
+                            messages = [e.error_message for e in val_res.validation_errors]
+                    except Exception as ex:
+                        messages = [_exception_message(ex)]
+                if messages is None:
+                    batch.append((index, document))
+                else:
+                    result.errors.append((index, messages))
+                if len(batch) == batch_size:
+                    self._ingest_batch(conn, dt_sid, search_columns, batch, result)
+                    batch = []
+            if len(batch) > 0:
+                self._ingest_batch(conn, dt_sid, search_columns, batch, result)
+        finally:
+            if not conn is None:
+                self._release_connection(conn)
+        return result
+
+    def reindex_full_texts(self, dt_sid, batch_size=1000):
+        """
+        Derives again the full_* texts of all the documents of a document
+        type, i.e. after changing the text_facets of its elements. Returns
+        the number of documents updated.
+
+        The documents are read in batches of batch_size, ordered by id, and
+        each batch is updated in its own transaction: the texts are sent
+        with COPY FROM STDIN to a temporary table and applied with a single
+        UPDATE. Reading and updating use the same connection. The tsv_*
+        columns are updated by the trigger.
+
+        Usage:
+
+        provider.reindex_full_texts("SI")
+        """
+        columns = ["full_" + f for f in self._full_text_facets]
+        count = 0
+        last_id = 0
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            while True:
+                cursor.execute("SELECT id, entire_document FROM sibac_main WHERE dt_sid = %s AND id > %s ORDER BY id LIMIT %s",
+                               (dt_sid, last_id, batch_size))
+                rows = cursor.fetchall()
+                if len(rows) == 0:
+                    break
+                lines = []
+                for doc_id, json_str in rows:
+                    document = Document(dt_sid=dt_sid, doc_id=doc_id, json_str=json_str, provider=self)
+                    full_texts = document.get_full_texts()
+                    values = [doc_id] + [full_texts[c] for c in columns]
+                    lines.append("\t".join([_copy_value(v) for v in values]) + "\n")
+                self._update_full_texts(cursor, columns, lines)
+                conn.commit()
+                count += len(rows)
+                last_id = rows[-1][0]
+            cursor.close()
+        finally:
+            if not conn is None:
+                self._release_connection(conn)
+        return count
+
+    def _backfill_search_columns(self, dt_sid, columns, state, state_key, batch_size, progress):
+        """
+        Fills the columns of the search table listed in columns, reading
+        the documents after state["last_id"] in batches. state is saved in
+        the state_key setting in the transaction of every batch.
+        """
+        total = self._execute_scalar("SELECT count(*) FROM sibac_main WHERE dt_sid = %s", dt_sid)
+        names = [c[0] for c in columns]
+        create_sql = "CREATE TEMP TABLE sibac_backfill (id integer PRIMARY KEY, {0}) ON COMMIT DROP".format(
+            ", ".join([c[0] + " " + self._get_search_column_type(c[1], c[2]) for c in columns]))
+        update_sql = "UPDATE {0}_search s SET {1} FROM sibac_backfill t WHERE s.id = t.id".format(
+            dt_sid, ", ".join(["{0} = t.{0}".format(n) for n in names]))
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            while True:
+                cursor.execute("SELECT id, entire_document FROM sibac_main WHERE dt_sid = %s AND id > %s ORDER BY id LIMIT %s",
+                               (dt_sid, state["last_id"], batch_size))
+                rows = cursor.fetchall()
+                if len(rows) == 0:
+                    break
+                lines = []
+                for doc_id, json_str in rows:
+                    document = Document(dt_sid=dt_sid, doc_id=doc_id, json_str=json_str, provider=self)
+                    values = [doc_id] + self._get_search_values(document, columns)
+                    lines.append("\t".join([_copy_value(v) for v in values]) + "\n")
+                cursor.execute(create_sql)
+                cursor.copy_expert("COPY sibac_backfill (id, {0}) FROM STDIN".format(", ".join(names)),
+                                   StringIO("".join(lines)))
+                cursor.execute(update_sql)
+                state["last_id"] = rows[-1][0]
+                state["done"] += len(rows)
+                cursor.execute("UPDATE sibac_settings SET sett_value=%s WHERE sett_key=%s",
+                               (json.dumps(state), state_key))
+                conn.commit()
+                if not progress is None:
+                    progress(state["done"], max(total, state["done"]))
+            cursor.close()
+        finally:
+            if not conn is None:
+                self._release_connection(conn)
+
+    def _update_full_texts(self, cursor, columns, lines):
+        """
+        Updates the full_* columns of sibac_main with a batch of COPY lines.
+        The caller commits the transaction.
+        """
+        cursor.execute("CREATE TEMP TABLE sibac_full_texts (id integer PRIMARY KEY, {0}) ON COMMIT DROP".format(
+            ", ".join([c + " text NOT NULL" for c in columns])))
+        cursor.copy_expert("COPY sibac_full_texts FROM STDIN", StringIO("".join(lines)))
+        cursor.execute("UPDATE sibac_main m SET {0} FROM sibac_full_texts t WHERE m.id = t.id".format(
+            ", ".join(["{0} = t.{0}".format(c) for c in columns])))
+
+    def _get_full_text_filter(self, text, dt_sid, facets):
+        """
+        Returns a tuple (from_where_str, params) for the full text search
+        methods. The query is matched against the tsv_* columns of the
+        facets, so that their GIN indexes can be used.
+
+        Raises ValueError if facets is empty or contains an unknown facet.
+        """
+        if len(facets) == 0:
+            raise ValueError("No full text facet specified")
+        for f in facets:
+            if not f in self._full_text_facets:
+                raise ValueError("Unknown full text facet: {0}".format(f))
+        lang = self.settings.SIBACDATASOURCE["FULLTEXT_LANG"]
+        matches = " OR ".join(["m.tsv_{0} @@ q.query".format(f) for f in facets])
+        sql_str = "FROM sibac_main m, plainto_tsquery(%s, %s) AS q(query) WHERE ({0})".format(matches)
+        params = [lang, text]
+        if not dt_sid is None:
+            sql_str += " AND m.dt_sid = %s"
+            params.append(dt_sid)
+        return sql_str, params
+
+    def full_text_search(self, text, dt_sid=None, weights=None, limit=20, offset=0):
+        """
+        Searches the documents that contain the words of text in the full
+        text columns, ordered by relevance. Returns a list of tuples
+        (document, rank).
+
+        weights is a dictionary that maps the facets ("who", "what", "where",
+        "from_where", "when", "doc") to the weight of their ts_rank() in the
+        rank of a document. Only the facets in weights are searched; the
+        default is {"doc": 1.0}. Raises ValueError if weights is empty or
+        contains an unknown facet, and ProviderError if the full text search
+        is disabled or the database lacks its columns (see
+        migrate_full_text()).
+
+        Usage:
+
+        provider.full_text_search("anfora", "RA", {"what": 1.0, "doc": 0.2}, limit=20, offset=40)
+        [(<Document>, 0.42), (<Document>, 0.31), ...]
+        """
+        if weights is None:
+            weights = {"doc": 1.0}
+        self._check_full_text()
+        from_where_str, params = self._get_full_text_filter(text, dt_sid, list(weights))
+        facets = [f for f in self._full_text_facets if f in weights]
+        rank_str = " + ".join(["%s * ts_rank(m.tsv_{0}, q.query)".format(f) for f in facets])
+        sql_str = "SELECT {0}, m.dt_sid, {1} AS rank {2} ORDER BY rank DESC, m.id LIMIT %s OFFSET %s"
+        sql_str = sql_str.format(self._documents_columns, rank_str, from_where_str)
+        params = [float(weights[f]) for f in facets] + params + [limit, offset]
+        rows = self._execute_fetchall(sql_str, *params)
+        return [(self._document_from_row(r[7], r), r[8]) for r in rows]
+
+    def full_text_count(self, text, dt_sid=None, weights=None):
+        """
+        Returns the number of documents found by full_text_search() with
+        the same arguments. Only the keys of weights are used.
+        """
+        if weights is None:
+            weights = {"doc": 1.0}
+        self._check_full_text()
+        from_where_str, params = self._get_full_text_filter(text, dt_sid, list(weights))
+        return self._execute_scalar("SELECT count(*) " + from_where_str, *params)
@@ -1,6 +1,31 @@
 # -*- coding: utf-8 -*-
-import re, copy
+import re, copy, operator, threading
+from collections import OrderedDict
 from sibaclib.documenttypes import FieldType, MediaType
+from sibaclib.errors import SearchExpressionError
+
+# Number of validated expressions kept by SearchExpression.validate_expression_string.
+EXPRESSION_CACHE_SIZE = 256
+
+_TOKEN_SPLITTER = re.compile(r'"(?:[^\\"]|\\.)*"|<=|>=|<|>|=|\[[a-z_.]+\]|[a-z_.]+|\*|\(|\)', re.IGNORECASE)
+
+# Keywords are case-insensitive. Element sids are not, so other tokens
+# are left as they are when an expression is normalized.
+_KEYWORDS = frozenset(["SELECT", "FROM", "WHERE", "ORDER_BY", "AND", "OR",
+                       "NOT", "LIKE", "ASC", "DESC"])
+
+# Metafields whose conditions compare integer values.
+_INTEGER_METAFIELDS = frozenset(["_id", "_count", "_attachment_count", "_author_id", "_last_editor_id"])
+
+# Error message for a condition on an integer metafield with another value.
+_NOT_AN_INTEGER_MESSAGE = "Il metacampo {0} richiede un numero intero come termine di paragone."
+
+def _parse_int(value):
+    """Converts the compare_to value of a condition to int, or returns None."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 class BooleanOperator:
     """Enum of all boolean operators used in search expressions."""
@@ -19,7 +44,24 @@ class ComparisonOperator:
     GREATER_OR_EQUAL       = 4
     LIKE                   = 5
 
-class SearchCondition:
+class _Freezable:
+    """
+    Base class for the parts of a search expression.
+
+    A frozen instance can't be modified: it's shared by all the callers
+    that get it from the expression cache.
+    """
+    _frozen = False
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise TypeError("Cached search expressions are read-only: use copy() to get a modifiable one.")
+        self.__dict__[name] = value
+
+    def _set_frozen(self, frozen):
+        self.__dict__["_frozen"] = frozen
+
+class SearchCondition(_Freezable):
     """Represents a single search condition.
     
     Attributes:
@@ -38,6 +80,13 @@ class SearchCondition:
         self.comp_op = comp_op
         self.compare_to = compare_to
 
+    def freeze(self):
+        """Makes this condition read-only."""
+        self._set_frozen(True)
+
+    def _thaw(self):
+        self._set_frozen(False)
+
     def __unicode__(self):
         """Represents the condition as unicode text."""
         if self.bool_op == BooleanOperator.AND:
@@ -70,7 +119,7 @@ class SearchCondition:
         """Represents the condition as text."""
         return unicode(self).encode('utf-8')
 
-class Parenthesis:
+class Parenthesis(_Freezable):
     """Represents a group of search conditions.
     
     Attributes:
@@ -87,6 +136,19 @@ class Parenthesis:
         else:
             self.conditions = conditions
 
+    def freeze(self):
+        """Makes this parenthesis and the nested conditions read-only."""
+        for c in self.conditions:
+            c.freeze()
+        self.__dict__["conditions"] = tuple(self.conditions)
+        self._set_frozen(True)
+
+    def _thaw(self):
+        for c in self.conditions:
+            c._thaw()
+        self.__dict__["conditions"] = list(self.conditions)
+        self._set_frozen(False)
+
     def fields_contain(self, words):
         """Returns true if any of the listed word is inside a field
            name used in this Parenthesis or in a nested one.
@@ -95,8 +157,7 @@ class Parenthesis:
 
         not_allowed: A single word or a list words.
         """
-        result = False
-        for c in conditions:
+        for c in self.conditions:
             if hasattr(c, "conditions"):
                 if c.fields_contain(words):
                     return True
@@ -127,7 +188,7 @@ class Parenthesis:
         """Represents the parenthesis as text."""
         return unicode(self).encode('utf-8')
 
-class OrderingCondition:
+class OrderingCondition(_Freezable):
     """An ordering condition, composed by a field name and a sorting direction.
 
     Attributes:
@@ -140,6 +201,13 @@ class OrderingCondition:
         self.field = field
         self.ascendant = ascendant
 
+    def freeze(self):
+        """Makes this ordering condition read-only."""
+        self._set_frozen(True)
+
+    def _thaw(self):
+        self._set_frozen(False)
+
     def __unicode__(self):
         """Represents the ordering condition as unicode text."""
         if self.ascendant:
@@ -152,7 +220,7 @@ class OrderingCondition:
         """Represents the ordering condition as text."""
         return unicode(self).encode('utf-8')
 
-class SearchExpression:
+class SearchExpression(_Freezable):
     """An graph of objects that describes the query to perform against the
     storage.
 
@@ -182,14 +250,74 @@ class SearchExpression:
         self.where = Parenthesis()
         self.order_by = []
 
+    def freeze(self):
+        """Makes this expression read-only.
+
+        Expressions returned by validate_expression_string() are frozen;
+        call copy() to get one that can be modified.
+        """
+        self.where.freeze()
+        for o in self.order_by:
+            o.freeze()
+        self.__dict__["select"] = tuple(self.select)
+        self.__dict__["order_by"] = tuple(self.order_by)
+        self._set_frozen(True)
+
+    def _thaw(self):
+        self.where._thaw()
+        for o in self.order_by:
+            o._thaw()
+        self.__dict__["select"] = list(self.select)
+        self.__dict__["order_by"] = list(self.order_by)
+        self._set_frozen(False)
+
+    def compile(self, document_type):
+        """Compiles the WHERE part of this expression into a predicate.
+
+        The predicate is a function that takes a sibaclib.documents.Document
+        of the given document type and returns True if the document satisfies
+        the expression. Paths are resolved, compare_to values converted and
+        comparison functions chosen only once, so the same predicate can be
+        applied to many documents. An expression without conditions
+        accepts every document.
+
+        Frozen expressions keep the last compiled predicate.
+
+        Raises SearchExpressionError if the expression uses metafields that
+        can't be evaluated on a document in memory.
+
+        Usage:
+
+        is_match = se.compile(doc_type)
+        matching_docs = [d for d in docs if is_match(d)]
+        """
+        compiled = self.__dict__.get("_compiled")
+        if not compiled is None and compiled[:2] == (document_type.sid, document_type.schema_hash):
+            return compiled[2]
+        if len(self.where.conditions) > 0:
+            predicate = _compile_conditions(document_type, self.where.conditions)
+        else:
+            predicate = lambda document: True
+        if self._frozen:
+            self.__dict__["_compiled"] = (document_type.sid, document_type.schema_hash, predicate)
+        return predicate
+
+    def copy(self):
+        """Returns a modifiable deep copy of this expression."""
+        new_expr = copy.deepcopy(self)
+        new_expr.__dict__.pop("_compiled", None)
+        new_expr._thaw()
+        return new_expr
+
     def _set_from_string(self, expr_str):
         """Private method, called by __init__() to set the expression
            properties from a string.
         """
+        self._set_from_tokens(_TOKEN_SPLITTER.findall(expr_str))
+
+    def _set_from_tokens(self, tokens):
+        """Sets the expression properties from the tokens of a string."""
         self.clear()
-        # Tokenize 
-        splitter = re.compile(r'"(?:[^\\"]|\\.)*"|<=|>=|<|>|=|\[[a-z_.]+\]|[a-z_.]+|\*|\(|\)', re.IGNORECASE)
-        tokens = splitter.findall(expr_str)
         interpreter = None
         for t in tokens:
             tup = t.upper()
@@ -218,21 +346,22 @@ class SearchExpression:
         an argument for the validate_against_expr method of the
         sibaclib.documents.Document class or to set permissions for a user.
         """
-        not_allowed = get_for_storage_only_metafields()
+        not_allowed = self.get_for_storage_only_metafields()
         # Search on 'SELECT' part.
         for word in not_allowed:
             for selected in self.select:
                 if word in selected:
-                    return False
+                    return True
         # Search on 'WHERE' part.
         if self.where.fields_contain(not_allowed):
-            return False
+            return True
         # Search on 'ORDER_BY' part.
         for word in not_allowed:
-            for ordered in self.order_by and word in ordered.field:
-                return False
-        # If you arrived here, that's ok!
-        return True
+            for ordered in self.order_by:
+                if word in ordered.field:
+                    return True
+        # If you arrived here, the expression can be used on any document.
+        return False
 
     def get_for_storage_only_metafields(self):
         result = [
@@ -296,24 +425,55 @@ class SearchExpression:
         """Validates an expression string.
 
         This method returns a tuple composed by a SearchExpressionValidationResult instance and
-        and an instance of the SearchExpression class. If the validation process returns errors,
+        and an instance of the SearchExpression class. If the expression can't be parsed,
         the second element of the tuple will be None.
+
+        Results are cached by normalized expression text: the returned expression is frozen
+        and shared, so call its copy() method before modifying it. A cached result is used
+        only while the schema of the document type is unchanged.
+
+        Usage:
+
+        val_res, se = SearchExpression.validate_expression_string('SELECT * FROM RA WHERE PVCP = "AN"', provider)
+        SearchExpression.cache_info()
+        {'hits': 0, 'misses': 1, 'size': 1, 'max_size': 256}
         """
-        se = None
-        try:
-            se = SearchExpression(search_expression_str)
-        except:
-            errors = ["Errore durante il parsing dell'espressione. Controlla la sintassi."]
-        if not se is None:
-            doc_type_sid = se.from_doc
-            if not doc_type_sid in provider.inspector.doc_types:
-                errors = ["Il tipo di documento specificato nella clausola FROM non esiste."]
-            else:
-                doc_type = provider.inspector.doc_types[doc_type_sid]
-                val_res = se.validate(doc_type, allow_for_storage_only)
-                errors = val_res.errors
+        tokens = _TOKEN_SPLITTER.findall(search_expression_str)
+        key = (tuple([t.upper() if t.upper() in _KEYWORDS else t for t in tokens]),
+               bool(allow_for_storage_only))
+        doc_types = provider.inspector.doc_types
+        entry = _expression_cache.get(key, doc_types)
+        if entry is None:
+            se = None
+            try:
+                se = SearchExpression()
+                se._set_from_tokens(tokens)
+            except:
+                se = None
+                errors = ["Errore durante il parsing dell'espressione. Controlla la sintassi."]
+            if not se is None:
+                doc_type_sid = se.from_doc
+                if not doc_type_sid in doc_types:
+                    errors = ["Il tipo di documento specificato nella clausola FROM non esiste."]
+                else:
+                    doc_type = doc_types[doc_type_sid]
+                    val_res = se.validate(doc_type, allow_for_storage_only)
+                    errors = val_res.errors
+                se.freeze()
+            entry = _expression_cache.put(key, doc_types, se, tuple(errors))
+        se, errors = entry
         is_valid = len(errors) == 0
-        return SearchExpressionValidationResult(is_valid, errors), se
+        return SearchExpressionValidationResult(is_valid, list(errors)), se
+
+    @staticmethod
+    def cache_info():
+        """Returns a dictionary with the statistics of the expression cache."""
+        return _expression_cache.get_info()
+
+    @staticmethod
+    def clear_cache():
+        """Empties the expression cache and resets its counters."""
+        _expression_cache.clear()
 
     def validate(self, document_type, allow_for_storage_only = False):
         """Validates the search expression.
@@ -365,7 +525,7 @@ class SearchExpression:
                                 c.comp_op == ComparisonOperator.LESSER_OR_EQUAL or \
                                 c.comp_op == ComparisonOperator.GREATER_OR_EQUAL:
                                 std_message = "Gli operatori <, >, <=, >= non possono essere usati sull'elemento {0}."
-                                if is_para_or_struct:
+                                if is_para_or_struc:
                                     if not metafield_name == "_count":
                                         errors.append(std_message.format(c.field))
                                 if is_doc_type:
@@ -376,25 +536,29 @@ class SearchExpression:
                                         errors.append(std_message.format(c.field))
                             if c.comp_op == ComparisonOperator.LIKE:
                                 std_message = "L'operatore LIKE non può essere usato sull'elemento {0}."
+                                # LIKE compares texts: the contents of a simple field,
+                                # or their values if they are strings.
                                 if not is_simple_field:
                                     errors.append(std_message.format(c.field))
-                                else:
-                                    if not (metafield_name is None or \
-                                        document_type.simple_fields[paths[0]].field_type == FieldType.STRING):
-                                        errors.append(std_message.format(c.field))
+                                elif not (metafield_name is None or \
+                                    (metafield_name == "_as_val" and \
+                                     document_type.simple_fields[paths[0]].field_type == FieldType.STRING)):
+                                    errors.append(std_message.format(c.field))
                             # Validate compare_to:
                             cto = c.compare_to
                             if not cto:
                                 errors.append("Una condizione di ricerca è priva di termine di paragone.")
                             else:
-                                if metafield_name == "_as_val" and document_type.get_val_from_text(c.compare_to, document_type.simple_fields[paths[0]]) is None:
+                                if metafield_name == "_as_val" and document_type.simple_fields[paths[0]].converter(c.compare_to) is None:
                                     errors.append("Tentativo di conversione fallito rispetto al tipo di dati di {1}.".format(c.compare_to, field_name))
+                                elif metafield_name in _INTEGER_METAFIELDS and _parse_int(cto) is None:
+                                    errors.append(_NOT_AN_INTEGER_MESSAGE.format(metafield_name))
                                         
                     is_first = False
             check_where_conditions(self.where)
         # Validate 'ORDER_BY' part
         for o in self.order_by:
-            _validate_field(document_type, s.name, errors, allow_for_storage_only)
+            self._validate_field(document_type, o.field, errors, allow_for_storage_only)
         is_valid = len(errors) == 0
         return SearchExpressionValidationResult(is_valid, errors)
 
@@ -423,7 +587,7 @@ class SearchExpression:
                     if document_type.simple_fields[paths[0]].media_type == MediaType.NONE:
                         errors.append("Il campo semplice {0} non può essere usato per il metacampo '_attachment_count' perché non può avere allegati.".format(field_name))
                 if not metafield_name in self.get_accepted_metafields():
-                    errors.append("Il metacampo {0} non esiste.").format(metafield_name)
+                    errors.append("Il metacampo {0} non esiste.".format(metafield_name))
                 if not allow_for_storage_only and metafield_name in self.get_for_storage_only_metafields():
                     errors.append("Il metacampo {0} non può essere usato per validare documenti non ancora salvati o per attribuire permessi utente.".format(metafield_name))
                 # Check if the metafield can be applied to the field.
@@ -453,11 +617,11 @@ class SearchExpression:
         print se3
         'SELECT * FROM [RA] WHERE ([PVCP]="AN" OR [PVCP]="MC") AND OGTD="Anfora"'
         """
-        new_expr = copy.deepcopy(expr_1)
+        new_expr = expr_1.copy()
         p1 = Parenthesis()
         p1.conditions = new_expr.where.conditions
         p2 = Parenthesis(bool_op = bool_op)
-        p2.conditions = copy.deepcopy(expr_2.where.conditions)
+        p2.conditions = expr_2.copy().where.conditions
         new_expr.where = Parenthesis(conditions = [p1, p2])
         new_expr.simplify()
         return new_expr
@@ -486,7 +650,7 @@ class SearchExpression:
         if len(self.where.conditions) > 0:
             expr_str += " WHERE " + " ".join([str(c) for c in self.where.conditions])
         if len(self.order_by) > 0:
-            expr_str += "ORDER_BY" + " ".join([str(o) for o in self.order_by])
+            expr_str += " ORDER_BY " + " ".join([str(o) for o in self.order_by])
         return expr_str
 
     def __str__(self):
@@ -525,7 +689,7 @@ class _WhereTokensInterpreter:
             self.current_bool_op = BooleanOperator.OR
         elif tup == "NOT":
             if self.current_bool_op is None:
-                self.current_bool_op is BooleanOperator.NOT
+                self.current_bool_op = BooleanOperator.NOT
             elif self.current_bool_op == BooleanOperator.AND:
                 self.current_bool_op = BooleanOperator.AND_NOT
             elif self.current_bool_op == BooleanOperator.OR:
@@ -573,10 +737,13 @@ class _OrderByTokensInterpreter:
 
     def read(self, token):
         tup = token.upper()
-        if tup == "ASC":
-            self.curr_ascendant = True
-        elif tup == "DESC":
-            self.curr_ascendant = False
+        if tup in ("ASC", "DESC"):
+            # The direction follows the field ("NCTN DESC"); a direction
+            # before the first field applies to it.
+            if len(self.se.order_by) > 0:
+                self.se.order_by[-1].ascendant = tup == "ASC"
+            else:
+                self.curr_ascendant = tup == "ASC"
         else:
             oc = OrderingCondition(token, self.curr_ascendant)
             self.se.order_by.append(oc)
@@ -596,3 +763,152 @@ class SearchExpressionValidationResult:
             self.errors = []
         else:
             self.errors = errors
+
+_COMPARISON_FUNCTIONS = {
+                            ComparisonOperator.EQUAL: operator.eq,
+                            ComparisonOperator.LESSER: operator.lt,
+                            ComparisonOperator.GREATER: operator.gt,
+                            ComparisonOperator.LESSER_OR_EQUAL: operator.le,
+                            ComparisonOperator.GREATER_OR_EQUAL: operator.ge,
+                        }
+
+def _compile_conditions(document_type, conditions):
+    """
+    Returns a predicate for a list of search conditions and parentheses.
+    Conditions are merged from left to right.
+    """
+    compiled = []
+    for c in conditions:
+        if hasattr(c, "conditions"):
+            predicate = _compile_conditions(document_type, c.conditions)
+        else:
+            predicate = _compile_condition(document_type, c)
+        is_and = c.bool_op in (BooleanOperator.AND, BooleanOperator.AND_NOT)
+        negate = c.bool_op in (BooleanOperator.NOT, BooleanOperator.AND_NOT, BooleanOperator.OR_NOT)
+        compiled.append((is_and, negate, predicate))
+    first_negate, first_predicate = compiled[0][1], compiled[0][2]
+    others = compiled[1:]
+    def evaluate_conditions(document):
+        result = first_predicate(document) != first_negate
+        for is_and, negate, predicate in others:
+            # Skip the conditions that can't change the result.
+            if result == is_and:
+                result = predicate(document) != negate
+        return result
+    return evaluate_conditions
+
+def _compile_int(metafield_name, compare_to):
+    """
+    Converts the compare_to value of a condition on an integer metafield.
+    Raises SearchExpressionError if it isn't an integer.
+    """
+    value = _parse_int(compare_to)
+    if value is None:
+        raise SearchExpressionError(_NOT_AN_INTEGER_MESSAGE.format(metafield_name))
+    return value
+
+def _compile_condition(document_type, condition):
+    """Returns a predicate for a single search condition."""
+    field = condition.field
+    if "._" in field:
+        metafield_name = field[field.index("._") + 1:]
+    else:
+        metafield_name = None
+    complete_path = document_type.get_complete_paths(field, error_if_ambiguous=True)[0]
+    comp_val = condition.compare_to
+    # Choose the function that returns the values to compare.
+    if metafield_name is None:
+        def get_values(document):
+            return document._get_contents_at(complete_path) or ()
+    elif metafield_name == "_as_val":
+        converter = document_type.simple_fields[complete_path].converter
+        comp_val = converter(comp_val)
+        def get_values(document):
+            values = [converter(v) for v in document._get_contents_at(complete_path) or ()]
+            return [v for v in values if not v is None]
+    elif metafield_name == "_count":
+        comp_val = _compile_int(metafield_name, comp_val)
+        def get_values(document):
+            return (len(document._get_contents_at(complete_path) or ()),)
+    elif metafield_name == "_package_name":
+        get_values = lambda document: (document.package_name,)
+    elif metafield_name in ("_id", "_author_id", "_last_editor_id"):
+        attr_name = "doc_id" if metafield_name == "_id" else metafield_name[1:]
+        comp_val = _compile_int(metafield_name, comp_val)
+        get_values = lambda document: (getattr(document, attr_name),)
+    else:
+        raise SearchExpressionError("Il metacampo {0} non può essere valutato su un documento.".format(metafield_name))
+    # Choose the comparison function.
+    op = condition.comp_op
+    if op == ComparisonOperator.LIKE:
+        if not isinstance(comp_val, basestring):
+            raise SearchExpressionError("L'operatore LIKE non può essere usato sull'elemento {0}.".format(field))
+        comp_val = comp_val.upper()
+        test = lambda v: comp_val in v.upper()
+    elif op == ComparisonOperator.EQUAL and isinstance(comp_val, basestring):
+        # String comparison is case-insensitive.
+        comp_val = comp_val.upper()
+        test = lambda v: v.upper() == comp_val
+    else:
+        comp_function = _COMPARISON_FUNCTIONS[op]
+        test = lambda v: comp_function(v, comp_val)
+    def evaluate_condition(document):
+        for v in get_values(document):
+            if not v is None and test(v):
+                return True
+        return False
+    return evaluate_condition
+
+class _ExpressionCache:
+    """
+    LRU cache used by SearchExpression.validate_expression_string().
+
+    Entries are keyed by the normalized tokens of the expression and
+    remember the schema_hash of the document type they were validated
+    against: an entry is discarded when the schema changes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_schema_hash(self, se, doc_types):
+        if se is None or not se.from_doc in doc_types:
+            return None
+        return doc_types[se.from_doc].schema_hash
+
+    def get(self, key, doc_types):
+        """Returns a tuple (expression, errors), or None if missing."""
+        with self._lock:
+            cached = self._entries.pop(key, None)
+            if not cached is None:
+                se, errors, schema_hash = cached
+                if schema_hash == self._get_schema_hash(se, doc_types):
+                    self._entries[key] = cached
+                    self.hits += 1
+                    return se, errors
+            self.misses += 1
+            return None
+
+    def put(self, key, doc_types, se, errors):
+        """Stores a frozen expression and its errors."""
+        with self._lock:
+            self._entries[key] = (se, errors, self._get_schema_hash(se, doc_types))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return se, errors
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "max_size": self.max_size}
+
+_expression_cache = _ExpressionCache(EXPRESSION_CACHE_SIZE)
@@ -1,8 +1,23 @@
 import os.path
 import importlib
+import multiprocessing
+import threading
 from dtinspector import DocumentTypesInspector
+from documents import Document
 import distutils.dir_util
 
+# Process-wide registries used by get_shared_provider() and
+# get_shared_inspector().
+_shared_providers = {}
+_shared_inspectors = {}
+_registry_lock = threading.RLock()
+
+# Provider used by the processes started by validate_documents().
+_worker_provider = None
+# Providers inherited from the parent by the processes started by
+# validate_documents(). See _init_validation_worker().
+_inherited_providers = []
+
 def create_sibac_app(target_folder=os.getcwd()):
     """Creates a SIBAC application in the specified folder.
 
@@ -24,8 +39,49 @@ def create_sibac_app(target_folder=os.getcwd()):
 
     print "SIBAC Application successfully created."
 
+def get_shared_inspector(document_types_folder):
+    """Returns the DocumentTypesInspector shared by the whole process for
+    the specified folder.
+
+    The inspector is created the first time the folder is requested and the
+    same instance is returned by all the following calls.
+    """
+    key = os.path.abspath(document_types_folder)
+    with _registry_lock:
+        inspector = _shared_inspectors.get(key)
+        if inspector is None:
+            inspector = DocumentTypesInspector(document_types_folder)
+            _shared_inspectors[key] = inspector
+    return inspector
+
+def get_shared_provider(settings, app_path):
+    """Returns the provider shared by the whole process for the specified
+    settings module and application path.
+
+    Use this function instead of initialize_provider() in modules that are
+    imported by every worker (views, context processors, etc.), so that the
+    document types are loaded only once per process.
+
+    Usage:
+
+    provider = get_shared_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+    """
+    key = (settings.__name__, os.path.abspath(app_path))
+    with _registry_lock:
+        provider = _shared_providers.get(key)
+        if provider is None:
+            provider = initialize_provider(settings, app_path)
+            _shared_providers[key] = provider
+    return provider
+
 def initialize_provider(settings, app_path):
-    inspector = DocumentTypesInspector(os.path.join(app_path, "sibacmodels"))
+    """Creates a new provider for the specified settings module and
+    application path.
+
+    The DocumentTypesInspector is shared with the other providers that use the
+    same application path.
+    """
+    inspector = get_shared_inspector(os.path.join(app_path, "sibacmodels"))
     provider_name = settings.SIBACDATASOURCE['PROVIDER']
     if isinstance(provider_name, basestring):
         # String are used for built-in providers.
@@ -34,3 +90,59 @@ def initialize_provider(settings, app_path):
         # Modules references are used for custom providers.
         prov_module = provider_name
     return prov_module.SibacProvider(settings, app_path, inspector)
+
+def validate_documents(provider, documents, dt_sid=None, processes=None, chunksize=20):
+    """Validates many documents in a pool of processes and yields their
+    DocumentValidationResult instances in the same order as documents.
+
+    documents can contain Document instances or json strings produced
+    by Document.json_encode(); dt_sid is the document type of the json
+    strings. The content and the media_files of the Document instances are
+    validated; their catalogation_level attribute is not updated, use the
+    one of the result. processes is the number of worker processes (default: the
+    number of CPUs). Each worker creates its own shared provider from the
+    settings module and the application path of provider, and loads the
+    document types and the dictionaries only once.
+
+    Usage:
+
+    for result in validate_documents(provider, provider.iter_documents("SI")):
+        print result.can_be_saved
+    """
+    pool = multiprocessing.Pool(processes, _init_validation_worker,
+                                (provider.settings.__name__, provider.app_path))
+    try:
+        args = ((dt_sid, d, []) if isinstance(d, basestring) else (d.dt_sid, d.json_encode(), d.media_files)
+                for d in documents)
+        for result in pool.imap(_validate_in_worker, args, chunksize):
+            yield result
+        pool.close()
+    finally:
+        # terminate() also stops the workers if the caller didn't consume
+        # all the results.
+        pool.terminate()
+        pool.join()
+
+def _init_validation_worker(settings_name, app_path):
+    """Initializer of the processes started by validate_documents()."""
+    global _worker_provider
+    # The forked process inherits the shared providers of the parent, with
+    # the connections of their pools: using them would mix the messages of
+    # different processes on the same sockets. They are replaced by new
+    # providers, but they are kept referenced, because closing their
+    # connections (also when they are garbage collected) would end the
+    # sessions of the parent.
+    with _registry_lock:
+        _inherited_providers.extend(_shared_providers.values())
+        _shared_providers.clear()
+    settings = importlib.import_module(settings_name)
+    _worker_provider = get_shared_provider(settings, app_path)
+    for dt_sid in _worker_provider.inspector.doc_types:
+        _worker_provider.get_dictionaries(dt_sid)
+
+def _validate_in_worker(args):
+    """Validates a document in a process started by validate_documents()."""
+    dt_sid, json_str, media_files = args
+    document = Document(dt_sid=dt_sid, json_str=json_str, provider=_worker_provider,
+                        media_files=media_files)
+    return document.validate()
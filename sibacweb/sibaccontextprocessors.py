@@ -1,5 +1,5 @@
 import os
-from sibaclib.django.webappsettings import ApplicationPermissions, DocumentPermissions, EmailSettings, WebAppSettings
+from sibaclib.django.webappsettings import ApplicationPermissions, DocumentPermissions, EmailSettings, WebAppSettings, WebAppSettingsCache
 import sibaclib.utils
 import sibacsettings
 #try:
@@ -8,15 +8,22 @@ import sibacsettings
 import pickle
 
 app_path = os.path.join(os.getcwd(), "sibacapp")
-provider = sibaclib.utils.initialize_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+provider = sibaclib.utils.get_shared_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
 
 def sibac_settings(request):
     """ Add a Web_App_Settings variable to the texmplate context.
 
-    The variable will point to a WebAppSettings instance.
+    The variable will point to a WebAppSettings instance, taken from
+    web_app_settings_cache.
+    """
+    return { "WebAppSettings": web_app_settings_cache.get() }
+
+def load_web_app_settings():
+    """Loads the WebAppSettings instance.
+
     Settings are stored in a database. If no settings are found in the db,
     this method will instantiate a new WebAppSettings object with default
-    attribute values.
+    attribute values. Permissions are aligned to the existing document types.
     """
     sett_serialized = provider.get_setting("_WebAppSettings")
     if sett_serialized:
@@ -39,4 +46,8 @@ def sibac_settings(request):
     for dt in provider.inspector.doc_types:
         if not dt in doc_permissions:
             doc_permissions[dt] = DocumentPermissions(dt_sid=dt)
-    return { "WebAppSettings": wapp_settings }
+    return wapp_settings
+
+# Settings are read from the database at most once every SETTINGS_CACHE_TTL seconds.
+web_app_settings_cache = WebAppSettingsCache(load_web_app_settings,
+                                             getattr(sibacsettings, "WEBAPP", {}).get("SETTINGS_CACHE_TTL", 30))
@@ -58,6 +58,29 @@ def remove_all_doc_types():
     docs_provider = get_provider()
     docs_provider.remove_all_doc_types()
 
+def migrate_doc_type(dt_sid):
+    """
+    This method updates the storage entities of a specific document type
+    after a change of its definition, keeping the stored documents.
+    If interrupted, it can be launched again to resume the migration.
+    """
+    docs_provider = get_provider()
+    docs_provider.migrate_doc_type(dt_sid,
+                                   progress=lambda done, total: print_progress(dt_sid, done, total))
+
+def migrate_all_doc_types():
+    """
+    This method updates the storage entities of all the document types
+    after a change of their definitions, keeping the stored documents.
+    It also adds the full text search columns if FULLTEXT has been enabled.
+    """
+    docs_provider = get_provider()
+    docs_provider.migrate_all_doc_types(progress=print_progress)
+
+def print_progress(dt_sid, done, total):
+    """Prints the progress of the migration of a document type."""
+    print "{0}: {1}/{2}".format(dt_sid, done, total)
+
 def get_provider():
     """
     This method gets an instance of the correct provider for managing a SIBAC
@@ -55,7 +55,7 @@ document_type_def = {
                 }
             ]
         },
-        { "sid": "OG", "alt": "Oggetto", "level": CatalogationLevel.I,
+        { "sid": "OG", "alt": "Oggetto", "level": CatalogationLevel.I, "text_facets": (TextFacet.WHAT,),
             "fields": [
                 { "sid": "OGT", "alt": "Oggetto", "level": CatalogationLevel.I,
                     "fields": [
@@ -68,7 +68,7 @@ document_type_def = {
                 }
             ]
         },
-        { "sid": "LC", "alt": "Localizzazione geografico-amministrativa", "level": CatalogationLevel.I, "repeatable": True,
+        { "sid": "LC", "alt": "Localizzazione geografico-amministrativa", "level": CatalogationLevel.I, "repeatable": True, "text_facets": (TextFacet.WHERE,),
             "fields": [
                 { "sid": "PVC", "alt": "Localizzazione geografico-amministrativa", "level": CatalogationLevel.I, "repeatable": True,
                     "fields": [
@@ -85,7 +85,7 @@ document_type_def = {
                 { "sid": "PVE", "alt": "Diocesi", "length": 50, "dictionary_type": DictionaryType.OPEN }
             ]
         },
-        { "sid": "CS", "alt": "Localizzazione catastale", "repeatable": True,
+        { "sid": "CS", "alt": "Localizzazione catastale", "repeatable": True, "text_facets": (TextFacet.WHERE,),
             "fields": [
                 { "sid": "CTL", "alt": "Tipo di localizzazione", "length": 40, "level": CatalogationLevel.I, "dictionary_type": DictionaryType.CLOSED },
                 { "sid": "CTS", "alt": "Localizzazione catastale", "level": CatalogationLevel.I, "repeatable": True,
@@ -8,7 +8,14 @@ SIBACDATASOURCE = {
     'FULLTEXT': True,            # True if the data source supports full text searches.
     'FULLTEXT_LANG': 'italian' , # Language used for full text searches.
     'USERS_TABLE': 'auth_user',  # Empty if no user management is required. 'auth_user' if using django + postgres.
-    'USERS_ID_FIELD': 'id'       # Empty if no user management is required. 'id' if using django + postgres.
+    'USERS_ID_FIELD': 'id',      # Empty if no user management is required. 'id' if using django + postgres.
+    'POOL_MIN_SIZE': 1,          # Connections opened when the provider is created.
+    'POOL_MAX_SIZE': 10,         # Max number of pooled connections. 0 disables connection pooling.
+    'POOL_TIMEOUT': 30,          # Seconds to wait for a free connection before raising an error.
+    'POOL_PING_AFTER': 30,       # Seconds of inactivity after which a pooled connection is tested before reuse.
+    'TERMS_CACHE': True,         # Keep dictionary terms in memory, reloading them after changes.
+    'TERMS_CACHE_NOTIFY': True,  # Use LISTEN/NOTIFY to keep the terms cache coherent across processes.
+    'STREAM_ITERSIZE': 2000      # Rows fetched per round trip when streaming large resultsets.
 }
 
 # GEOREFERENCING:
@@ -27,3 +34,20 @@ SIBACDATASOURCE = {
 GEOREFERENCING = {
     'EPSGID': 4326,
 }
+
+# WEB APPLICATION:
+#
+# SETTINGS_CACHE_TTL:
+#    Seconds for which each process keeps in memory the web application settings
+#    read from the database. Saving the settings refreshes them immediately in the
+#    process that saved them; the other processes will reload them when their
+#    copy expires.
+#
+# STATIC_CONTENT_CACHE_TTL:
+#    The same, for the contents of the home, about, links and contacts pages.
+#
+
+WEBAPP = {
+    'SETTINGS_CACHE_TTL': 30,
+    'STATIC_CONTENT_CACHE_TTL': 30,
+}
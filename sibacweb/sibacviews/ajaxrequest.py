@@ -1,37 +1,105 @@
 from django.http import HttpResponse, Http404
 from django.utils import simplejson
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 import os
+import threading
 from HTMLParser import HTMLParser
 import sibaclib.utils
 import sibacsettings
 from sibaclib.search import SearchExpression
 
 #Initialize sibac provider.
-provider = sibaclib.utils.initialize_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+provider = sibaclib.utils.get_shared_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+
+# Seconds for which browsers can use schema responses without revalidating them.
+SCHEMA_MAX_AGE = 300
+
+# Maximum number of terms returned by get_terms.
+MAX_TERMS_LIMIT = 100
+
+# (payload name, dt_sid) -> (schema_hash, serialized payload)
+_schema_payloads = {}
+_schema_payloads_lock = threading.Lock()
 
 # TODO: Check user permissions.
 
-def get_dt_paragraphs(request):
-    """Returns a list of paragraphs for a specific document type."""
-    if request.method == 'GET':
-        dt_sid = request.GET["dt_sid"]
-        dt = provider.inspector.doc_types[dt_sid]
-        paragraphs = [{ "sid": p.sid, "alt": p.alt } for p in dt.paragraphs]
-        response = simplejson.dumps({"paragraphs": paragraphs})
-        return HttpResponse (response, mimetype='application/json')
-    else:
-        raise Http404()
+def _get_paragraphs_payload(dt):
+    return {"paragraphs": [{ "sid": p.sid, "alt": p.alt } for p in dt.paragraphs]}
 
-def get_dt_fields(request):
-    """Returns the list of simple fields and subfields for a specific document_type."""
-    if request.method == 'GET':
-        dt_sid = request.GET["dt_sid"]
-        dt = provider.inspector.doc_types[dt_sid]
-        fields = [{"sid": k, "text": v.alt} for k, v in dt.simple_fields.iteritems()] 
-        response = simplejson.dumps({"fields": fields})
-        return HttpResponse (response, mimetype='application/json')
+def _get_fields_payload(dt):
+    return {"fields": [{"sid": k, "text": v.alt} for k, v in dt.simple_fields.iteritems()]}
+
+def _get_element_tree(element, parent_path):
+    """Returns a dictionary describing an element and its contents."""
+    path = parent_path + "." + element.sid
+    node = {"sid": element.sid, "alt": element.alt, "path": path,
+            "repeatable": element.repeatable}
+    if hasattr(element, "fields"):
+        node["fields"] = [_get_element_tree(f, path) for f in element.fields]
     else:
-        raise Http404()
+        node["field_type"] = element.field_type
+    return node
+
+def _get_schema_payload(dt):
+    payload = {"dt_sid": dt.sid, "alt": dt.alt,
+               "tree": [_get_element_tree(p, dt.sid) for p in dt.paragraphs]}
+    payload.update(_get_paragraphs_payload(dt))
+    payload.update(_get_fields_payload(dt))
+    return payload
+
+_payload_builders = {
+    "paragraphs": _get_paragraphs_payload,
+    "fields": _get_fields_payload,
+    "schema": _get_schema_payload,
+}
+
+def _get_serialized_payload(name, dt_sid):
+    """
+    Returns a tuple (etag, json string) for a schema payload, serializing
+    it only the first time it's requested for the current schema version.
+    Returns (None, None) if the document type doesn't exist.
+    """
+    dt = provider.inspector.doc_types.get(dt_sid)
+    if dt is None:
+        return None, None
+    key = (name, dt_sid)
+    with _schema_payloads_lock:
+        cached = _schema_payloads.get(key)
+        if cached is None or not cached[0] == dt.schema_hash:
+            cached = (dt.schema_hash, simplejson.dumps(_payload_builders[name](dt)))
+            _schema_payloads[key] = cached
+    return "{0}-{1}-{2}".format(name, dt_sid, dt.schema_hash), cached[1]
+
+def _schema_view(name):
+    """
+    Creates a view that returns a schema payload, with an ETag derived
+    from the schema_hash of the document type. Requests with a matching
+    If-None-Match header are answered with 304.
+    """
+    def etag(request):
+        return _get_serialized_payload(name, request.GET.get("dt_sid"))[0]
+    @cache_control(public=True, max_age=SCHEMA_MAX_AGE)
+    @condition(etag_func=etag)
+    def view(request):
+        if request.method == 'GET':
+            json_str = _get_serialized_payload(name, request.GET.get("dt_sid"))[1]
+            if json_str is None:
+                raise Http404()
+            return HttpResponse (json_str, mimetype='application/json')
+        else:
+            raise Http404()
+    return view
+
+get_dt_paragraphs = _schema_view("paragraphs")
+get_dt_paragraphs.__doc__ = "Returns a list of paragraphs for a specific document type."
+
+get_dt_fields = _schema_view("fields")
+get_dt_fields.__doc__ = "Returns the list of simple fields and subfields for a specific document_type."
+
+get_dt_schema = _schema_view("schema")
+get_dt_schema.__doc__ = """Returns in a single response the paragraphs, the simple fields and the
+tree of all the elements of a specific document type."""
 
 def validate_search_expression(request):
     """Validates a search expression."""
@@ -52,3 +120,30 @@ def validate_search_expression(request):
     else:
         raise Http404()
 
+def get_terms(request):
+    """
+    Returns the dictionary terms of a field starting with the specified text.
+    limit must be a non-negative integer; values greater than MAX_TERMS_LIMIT
+    are reduced to it.
+    """
+    if request.method == 'GET':
+        field_path = request.GET.get("field_path", None)
+        if not field_path:
+            return HttpResponse(status=400)
+        starts_with = request.GET.get("starts_with", None)
+        try:
+            limit = int(request.GET.get("limit", 20))
+        except ValueError:
+            return HttpResponse(status=400)
+        if limit < 0:
+            return HttpResponse(status=400)
+        limit = min(limit, MAX_TERMS_LIMIT)
+        dt_sid = provider.inspector.get_doc_type_sid(field_path)
+        if not dt_sid in provider.inspector.doc_types:
+            raise Http404()
+        terms = provider.get_terms_with_urls(field_path, starts_with, limit)
+        response = simplejson.dumps({"terms": [{"term": t, "url": u} for t, u in terms]})
+        return HttpResponse (response, mimetype='application/json')
+    else:
+        raise Http404()
+
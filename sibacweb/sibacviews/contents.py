@@ -1,31 +1,88 @@
 from django.shortcuts import render
+import hashlib
 import os
+import threading
+import time
+from datetime import datetime
 import sibaclib.utils
 import sibacsettings
 from django.http import HttpResponse, Http404
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
+from sibaccontextprocessors import web_app_settings_cache
 
 #Initialize sibac provider.
-provider = sibaclib.utils.initialize_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+provider = sibaclib.utils.get_shared_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
 
-def serve_static_content(key, request):
+# Seconds for which the contents read from the database are kept in memory.
+STATIC_CONTENT_CACHE_TTL = getattr(sibacsettings, "WEBAPP", {}).get("STATIC_CONTENT_CACHE_TTL", 30)
+
+# key -> [content, sha1 of content, loaded_at timestamp, expiration timestamp]
+_static_contents = {}
+_static_contents_lock = threading.Lock()
+
+def _get_static_content(key):
+    """
+    Returns a tuple (content, content_hash, loaded_at) for a static page,
+    reading the content from the database only when the cached copy has
+    expired. loaded_at changes only when the content changes.
+    """
+    now = time.time()
+    with _static_contents_lock:
+        cached = _static_contents.get(key)
+        if cached is None or now >= cached[3]:
+            content = provider.get_setting(key)
+            content_hash = hashlib.sha1((content or u"").encode("utf-8")).hexdigest()
+            if cached is None or not cached[1] == content_hash:
+                cached = [content, content_hash, now, 0]
+                _static_contents[key] = cached
+            cached[3] = now + STATIC_CONTENT_CACHE_TTL
+        return cached[0], cached[1], cached[2]
+
+def _invalidate_static_content(key):
+    with _static_contents_lock:
+        _static_contents.pop(key, None)
+
+# The rendered pages also depend on the user (login box) and on the web
+# application settings: validators are sent only to anonymous users and
+# include the settings fingerprint.
+
+def _static_content_etag(request, key):
+    if request.method == 'GET' and not request.user.is_authenticated():
+        content_hash = _get_static_content(key)[1]
+        web_app_settings_cache.get()
+        return content_hash[:20] + web_app_settings_cache.fingerprint[:20]
+    return None
+
+def _static_content_last_modified(request, key):
+    if request.method == 'GET' and not request.user.is_authenticated():
+        loaded_at = _get_static_content(key)[2]
+        web_app_settings_cache.get()
+        return datetime.utcfromtimestamp(int(max(loaded_at, web_app_settings_cache.loaded_at)))
+    return None
+
+@vary_on_cookie
+@condition(etag_func=_static_content_etag, last_modified_func=_static_content_last_modified)
+def serve_static_content(request, key):
     if request.method == 'GET':
-        content = provider.get_setting(key)
+        content = _get_static_content(key)[0]
         return render(request, 'static_content.html', { "page_content": content })
     elif request.method == 'POST':
         page_content = request.POST["page_content"]
         provider.change_setting(key, page_content)
+        _invalidate_static_content(key)
         return HttpResponse()
     else:
         raise Http404()
 
 def home(request):
-    return serve_static_content("_StaticContentHome", request)
+    return serve_static_content(request, "_StaticContentHome")
 
 def about(request):
-    return serve_static_content("_StaticContentAbout", request)
+    return serve_static_content(request, "_StaticContentAbout")
 
 def links(request):
-    return serve_static_content("_StaticContentLinks", request)
+    return serve_static_content(request, "_StaticContentLinks")
 
 def contacts(request):
-    return serve_static_content("_StaticContentContacts", request)
+    return serve_static_content(request, "_StaticContentContacts")
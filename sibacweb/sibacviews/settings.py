@@ -5,6 +5,7 @@ from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, Http404
 from sibaclib.django.webappsettings import WebAppSettings
+from sibaccontextprocessors import web_app_settings_cache
 import os
 import sibaclib.utils
 import sibacsettings
@@ -15,7 +16,7 @@ import sibacsettings
 import pickle
 
 #Initialize sibac provider.
-provider = sibaclib.utils.initialize_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
+provider = sibaclib.utils.get_shared_provider(sibacsettings, os.path.dirname(sibacsettings.__file__))
 
 @login_required
 def settings(request):
@@ -27,6 +28,7 @@ def settings(request):
         # inconsistent json.
         app_settings = WebAppSettings.from_json(json_str)
         provider.change_setting("_WebAppSettings", app_settings.to_json())
+        web_app_settings_cache.invalidate()
         return HttpResponse()
     else:
         raise Http404()
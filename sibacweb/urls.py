@@ -23,7 +23,9 @@ urlpatterns = patterns('',
     # Ajax requests
     url(r'^ajaxrequest/get_dt_paragraphs$', 'sibacweb.sibacviews.ajaxrequest.get_dt_paragraphs', name='get_dt_paragraphs'),
     url(r'^ajaxrequest/get_dt_fields$', 'sibacweb.sibacviews.ajaxrequest.get_dt_fields', name='get_dt_fields'),
+    url(r'^ajaxrequest/get_dt_schema$', 'sibacweb.sibacviews.ajaxrequest.get_dt_schema', name='get_dt_schema'),
     url(r'^ajaxrequest/validate_search_expression$', 'sibacweb.sibacviews.ajaxrequest.validate_search_expression', name='validate_search_expression'),
+    url(r'^ajaxrequest/get_terms$', 'sibacweb.sibacviews.ajaxrequest.get_terms', name='get_terms'),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),